@@ -12,7 +12,7 @@ from viewflow.models import Process, Task
 from viewflow.admin import ProcessAdmin, TaskAdmin
 from material.frontend.models import Module
 
-from michelin_bpm.main.models import ProposalProcess, Correction, BibServeProcess
+from michelin_bpm.main.models import ProposalProcess, Correction, BibServeProcess, OutgoingMail, TaskEvent
 
 
 User = get_user_model()
@@ -56,6 +56,18 @@ class ProposalProcessAdmin(VersionAdmin):
     ]
 
 
+class OutgoingMailAdmin(admin.ModelAdmin):
+    list_display = ('slug', 'recipient', 'status', 'attempts', 'created', 'sent')
+    list_filter = ('status', 'slug')
+    search_fields = ('recipient',)
+
+
+class TaskEventAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'task', 'attempts', 'next_attempt_at', 'created')
+    list_filter = ('kind',)
+    raw_id_fields = ('task',)
+
+
 class SiteAdmin(admin.ModelAdmin):
     list_display = ('domain', 'name')
     search_fields = ('domain', 'name')
@@ -75,3 +87,6 @@ admin_site.register(Module, ModuleAdmin)
 admin_site.register(BibServeProcess)
 
 admin_site.register(Site, SiteAdmin)
+
+admin_site.register(OutgoingMail, OutgoingMailAdmin)
+admin_site.register(TaskEvent, TaskEventAdmin)
@@ -34,5 +34,8 @@ class MichelinBPMFrontendConfig(ViewflowFrontendConfig):
 
 def register(flow_class, viewset_class=None):
     from django.apps import apps
+    from michelin_bpm.main.refs import register_flow
+
     apps.get_app_config('michelin_viewflow_frontend').register(flow_class, viewset_class=viewset_class)
+    register_flow(flow_class)
     return flow_class
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Пул долгоживущих процессов LibreOffice для конвертации документов (odt -> pdf).
+
+templated_docs.fill_template запускает для каждой конвертации новый процесс с LibreOffice,
+и холодный старт офиса занимает большую часть времени скачивания Договора.
+Здесь каждый процесс пула один раз поднимает LibreOffice (pylokit.Office) и дальше
+принимает задания через multiprocessing.Pipe.
+
+>>> pdf_path = converter_pool.convert('/tmp/contract.odt', 'pdf')
+"""
+import os
+import queue
+import logging
+import threading
+from multiprocessing import Process, Pipe
+from tempfile import NamedTemporaryFile
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionError(Exception):
+    pass
+
+
+def _converter_process(conn, lo_path):
+    """Процесс пула: держит открытый LibreOffice и конвертирует присланные файлы, пока канал не закроют."""
+    from pylokit import Office
+
+    with Office(lo_path) as lo:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+
+            filename, output_format = job
+            conv_file = NamedTemporaryFile(delete=False, suffix='.%s' % output_format)
+            conv_file.close()
+            converted = False
+            try:
+                with lo.documentLoad(filename) as doc:
+                    doc.saveAs(str(conv_file.name))
+                converted = True
+            except Exception as exc:
+                conn.send((False, str(exc)))
+            else:
+                conn.send((True, conv_file.name))
+            finally:
+                # Результат неудачной конвертации никому не отдаётся
+                if not converted:
+                    os.unlink(conv_file.name)
+
+
+class ConverterWorker:
+    """Один процесс с LibreOffice и канал для отправки ему заданий."""
+
+    def __init__(self, lo_path):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_converter_process, args=(child_conn, lo_path), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def convert(self, filename, output_format, timeout):
+        """
+        Отправляет задание процессу и ждёт результат не дольше timeout секунд.
+        Если процесс завис или упал, выбрасывает ConversionError, процесс после этого использовать нельзя.
+        """
+        try:
+            self.conn.send((filename, output_format))
+            if not self.conn.poll(timeout):
+                raise ConversionError('LibreOffice did not respond in {} s'.format(timeout))
+            ok, result = self.conn.recv()
+        except (EOFError, OSError) as exc:
+            raise ConversionError('LibreOffice process died: {}'.format(exc))
+        if not ok:
+            # Ошибка в самом документе, процесс остаётся рабочим
+            raise ValueError(result)
+        return result
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+
+class ConverterPool:
+    """
+    Пул из size процессов ConverterWorker, процессы запускаются по мере надобности.
+    Если все процессы заняты, задание ждёт свободный не дольше queue_timeout секунд.
+    Зависший или упавший процесс убивается и при следующем обращении заменяется новым.
+    """
+
+    def __init__(self, size, timeout, queue_timeout, lo_path):
+        self.size = size
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.lo_path = lo_path
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._started < self.size:
+                self._started += 1
+                try:
+                    return ConverterWorker(self.lo_path)
+                except Exception:
+                    self._started -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            raise ConversionError('No free LibreOffice process in {} s'.format(self.queue_timeout))
+
+    def _release(self, worker):
+        self._idle.put(worker)
+
+    def _discard(self, worker):
+        worker.stop()
+        with self._lock:
+            self._started -= 1
+
+    def convert(self, filename, output_format):
+        """Конвертирует файл filename в формат output_format и возвращает путь к новому временному файлу."""
+        worker = self._acquire()
+        if not worker.is_alive():
+            logger.warning('LibreOffice process %s is dead, restarting', worker.process.pid)
+            self._discard(worker)
+            worker = self._acquire()
+
+        try:
+            result = worker.convert(filename, output_format, self.timeout)
+        except ConversionError:
+            logger.exception('LibreOffice process %s failed, restarting', worker.process.pid)
+            self._discard(worker)
+            raise
+        except Exception:
+            self._release(worker)
+            raise
+        self._release(worker)
+        return result
+
+    def stop(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(worker)
+
+
+converter_pool = ConverterPool(
+    size=getattr(settings, 'LIBREOFFICE_POOL_SIZE', 2),
+    timeout=getattr(settings, 'LIBREOFFICE_CONVERT_TIMEOUT', 60),
+    queue_timeout=getattr(settings, 'LIBREOFFICE_QUEUE_TIMEOUT', 30),
+    lo_path=getattr(settings, 'TEMPLATED_DOCS_LIBREOFFICE_PATH', '/usr/lib/libreoffice/program/'),
+)
+
+
+def convert_document(filename, output_format):
+    """Конвертирует файл через converter_pool, исходный файл удаляется."""
+    try:
+        return converter_pool.convert(filename, output_format)
+    finally:
+        os.unlink(filename)
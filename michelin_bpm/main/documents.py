@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Генерация документов по Заявке: Договор (pdf) и Карточка ОИЗ (xls).
+
+Готовые документы кэшируются на диске. Ключ кэша - хэш шаблона, id последней Версии Заявки
+и хэш её Доставочных адресов, поэтому повторное скачивание неизменившейся Заявки отдаётся из кэша,
+а после любого изменения документ рендерится заново.
+"""
+import os
+import glob
+import json
+import time
+import locale
+import shutil
+import hashlib
+import logging
+import calendar
+import zipfile
+import threading
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import NamedTemporaryFile
+
+from templated_docs import fill_template, find_template_file
+
+from django.conf import settings
+from django.db.models import Prefetch
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.translation import ugettext_lazy as l_
+
+from viewflow.models import Task
+
+from michelin_bpm.main.models import ProposalProcess, DeliveryAddress
+from michelin_bpm.main.utils import ExcelLayout
+from michelin_bpm.main.refs import task_ref
+from michelin_bpm.main.converter import convert_document
+
+
+logger = logging.getLogger(__name__)
+
+CONTRACT_TEMPLATE_NAME = 'main/contract.odt'
+OIZ_CARD_TEMPLATE_PATH = '{}/static/main/proposal-info.xls'.format(os.path.abspath(os.path.dirname(__file__)))
+
+
+class RenderCache:
+    """
+    Файловый кэш готовых документов, ограниченный суммарным размером.
+    При превышении размера удаляются документы, которые дольше всех не скачивали (по mtime).
+    Файлы называются <kind>/<proposal_pk>-<key>.<ext>, по ним можно найти все документы Заявки:
+    при сохранении нового документа прежние документы того же вида по Заявке удаляются как устаревшие.
+    """
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_path(self, kind, proposal_pk, key, ext):
+        return os.path.join(self.root, kind, '{}-{}.{}'.format(proposal_pk, key, ext))
+
+    def open(self, path):
+        """Возвращает открытый документ из кэша или None, если его там нет."""
+        document = None
+        try:
+            document = open(path, 'rb')
+            # Отмечаем использование для вытеснения по LRU
+            os.utime(path)
+        except FileNotFoundError:
+            # Файла нет, или его удалили evict/invalidate другого запроса сразу после открытия
+            if document is not None:
+                document.close()
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return document
+
+    def store(self, path, filename):
+        """Перемещает отрендеренный файл filename в кэш и возвращает его открытым."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Имя временного файла уникально, одновременно в кэш может сохранять несколько потоков
+        with NamedTemporaryFile(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.',
+                                suffix='.tmp', delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+        shutil.move(filename, tmp_path)
+        os.replace(tmp_path, path)
+        document = open(path, 'rb')
+        self.invalidate(path)
+        self.evict()
+        return document
+
+    def invalidate(self, path):
+        """Удаляет устаревшие документы того же вида по той же Заявке, что и path."""
+        dirname, name = os.path.split(path)
+        proposal_pk = name.split('-', 1)[0]
+        for stale_path in glob.glob(os.path.join(dirname, '{}-*'.format(proposal_pk))):
+            if stale_path == path or stale_path.endswith('.tmp'):
+                continue
+            try:
+                os.unlink(stale_path)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """Удаляет самые давно использованные документы, пока кэш не уложится в max_size."""
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total * 100 if total else 0
+
+
+render_cache = RenderCache(
+    getattr(settings, 'DOCUMENTS_CACHE_ROOT', os.path.join(settings.MEDIA_ROOT, 'documents-cache')),
+    getattr(settings, 'DOCUMENTS_CACHE_MAX_SIZE', 512 * 1024 * 1024)
+)
+
+
+@lru_cache(maxsize=None)
+def _get_file_hash(path, mtime):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_file_hash(path):
+    """Хэш содержимого файла шаблона. Пересчитывается, только если файл изменился."""
+    return _get_file_hash(path, os.stat(path).st_mtime)
+
+
+def get_delivery_addresses_hash(delivery_addresses):
+    data = [
+        [getattr(da, f.attname) for f in da._meta.concrete_fields]
+        for da in delivery_addresses
+    ]
+    return hashlib.sha1(json.dumps(data, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def render_document(kind, proposal, ext, template_path, render):
+    """
+    Возвращает открытый файл документа по Заявке: из кэша или отрендеренный функцией
+    render(proposal, delivery_addresses), которая должна вернуть путь к временному файлу.
+    """
+    delivery_addresses = list(proposal.deliveryaddress_set.order_by('pk'))
+    key = hashlib.sha1('{}:{}:{}'.format(
+        get_file_hash(template_path),
+        proposal.get_last_version_id(),
+        get_delivery_addresses_hash(delivery_addresses)
+    ).encode()).hexdigest()
+    path = render_cache.get_path(kind, proposal.pk, key, ext)
+
+    document = render_cache.open(path)
+    if document is not None:
+        logger.info('%s for proposal #%s: cache hit, hit rate %.1f%% (%s hits, %s misses)',
+                    kind, proposal.pk, render_cache.hit_rate(), render_cache.hits, render_cache.misses)
+        return document
+
+    start = time.monotonic()
+    document = render_cache.store(path, render(proposal, delivery_addresses))
+    logger.info('%s for proposal #%s: rendered in %.3f s, hit rate %.1f%% (%s hits, %s misses)',
+                kind, proposal.pk, time.monotonic() - start,
+                render_cache.hit_rate(), render_cache.hits, render_cache.misses)
+    return document
+
+
+def get_contract_context(p, delivery_addresses):
+    """Контекст для шаблона Договора."""
+    da = delivery_addresses[0] if delivery_addresses else None
+
+    try:
+        locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
+    except locale.Error:
+        logger.error('Can\'t set russian locale (get month name)!')
+    contract_month_name = calendar.month_name[p.contract_date.month] if p.contract_date else ''
+
+    def get_full_address(list_of_parts):
+        return ', '.join(filter(bool, list_of_parts))
+
+    context = vars(p)
+    context = {k: (v if v else '') for k, v in context.items()}
+    more = {
+        'p': p,
+        'pcd': p.contract_date.day if p.contract_date else '',
+        'pcm': contract_month_name,
+        'pcy': p.contract_date.year if p.contract_date else '',
+        'full_address': get_full_address([p.zip_code, p.country, p.region, p.city, p.street, p.building, p.block]),
+        'jur_full_address': get_full_address([p.jur_zip_code, p.jur_country, p.jur_region, p.jur_city,
+                                              p.jur_street, p.jur_building, p.jur_block]),
+        'delivery_full_address': get_full_address([da.delivery_zip_code, da.delivery_country, da.delivery_region,
+                                                   da.delivery_city, da.delivery_street, da.delivery_building,
+                                                   da.delivery_block]) if da else '',
+    }
+    return {**context, **more}
+
+
+OIZ_CARD_LAYOUT = ExcelLayout(
+    OIZ_CARD_TEMPLATE_PATH,
+    cells={
+        (1, 0): 'company_name',
+        (1, 8): lambda p: p.date.strftime('%d/%m/%Y'),
+        (3, 0): 'operation_type_name',
+        (10, 1): 'jur_form',
+        (10, 5): 'client_name',
+
+        (17, 4): 'jur_zip_code',
+        (17, 7): 'jur_country',
+        (18, 3): 'jur_region',
+        (18, 7): 'jur_city',
+        (19, 1): 'jur_street',
+        (19, 5): 'jur_building',
+        (19, 7): 'jur_block',
+        (20, 1): 'inn',
+        (20, 3): 'kpp',
+        (20, 5): 'okpo',
+        (20, 7): 'ogrn',
+
+        (23, 2): 'bank_details',
+        (24, 1): 'bik',
+        (24, 3): 'corr_account_number',
+        (25, 2): 'account_number',
+
+        (27, 3): 'contract_number',
+        (27, 6): lambda p: p.contract_date.strftime('%d/%m/%Y') if p.contract_date else '',
+
+        (29, 4): 'zip_code',
+        (29, 7): 'country',
+        (30, 3): 'region',
+        (30, 7): 'city',
+        (31, 1): 'street',
+        (31, 5): 'building',
+        (31, 7): 'block',
+
+        (32, 3): 'dir_name',
+        (32, 7): 'dir_tel',
+        (33, 1): 'dir_email',
+        (33, 7): 'dir_fax',
+
+        (34, 2): 'buh_name',
+        (34, 7): 'buh_tel',
+        (35, 1): 'buh_email',
+        (35, 7): 'buh_fax',
+
+        (36, 2): 'contact_name',
+        (36, 7): 'contact_tel',
+        (37, 1): 'contact_email',
+        (37, 7): 'contact_fax',
+
+        (39, 8): lambda p: l_('Да') if p.is_needs_bibserve_account else l_('Нет'),
+        (40, 2): 'bibserve_login',
+        (41, 1): 'bibserve_email',
+        (41, 7): 'bibserve_tel',
+
+        (65, 0): 'company_name',
+    },
+    # Доставочные адреса, не больше 5
+    repeated_cells={
+        (0, 5): 'delivery_client_name',
+        (1, 4): 'delivery_zip_code',
+        (1, 7): 'delivery_country',
+        (2, 3): 'delivery_region',
+        (2, 7): 'delivery_city',
+        (3, 1): 'delivery_street',
+        (3, 5): 'delivery_building',
+        (3, 7): 'delivery_block',
+        (4, 3): 'delivery_contact_name',
+        (4, 7): 'delivery_tel',
+        (5, 7): 'delivery_fax',
+        (6, 5): 'delivery_email',
+
+        (10, 4): 'warehouse_working_hours_from',
+        (10, 6): 'warehouse_working_hours_to',
+        (11, 4): 'warehouse_break_from',
+        (11, 6): 'warehouse_break_to',
+        (13, 2): 'warehouse_comment',
+        (16, 2): 'warehouse_consignee_code',
+        (17, 2): 'warehouse_station_code',
+        (15, 7): 'warehouse_tc',
+        (16, 7): 'warehouse_pl',
+        (17, 7): 'warehouse_gc',
+        (18, 7): 'warehouse_ag',
+        (19, 7): 'warehouse_2r',
+    },
+    repeat_offsets=[43, 108, 132, 156, 180],
+)
+
+
+def _render_contract(p, delivery_addresses):
+    # Шаблон заполняется в odt, а в pdf конвертируется пулом LibreOffice (см. main.converter)
+    filename = fill_template(CONTRACT_TEMPLATE_NAME, get_contract_context(p, delivery_addresses), output_format='odt')
+    return convert_document(filename, 'pdf')
+
+
+def _render_oiz_card(p, delivery_addresses):
+    excel = OIZ_CARD_LAYOUT.render(p, delivery_addresses)
+    with NamedTemporaryFile(delete=False, suffix='.xls') as f:
+        f.write(excel.getvalue())
+    return f.name
+
+
+def render_contract(p):
+    """Договор по Заявке в формате pdf (открытый файл)."""
+    return render_document('contract', p, 'pdf', find_template_file(CONTRACT_TEMPLATE_NAME), _render_contract)
+
+
+def render_oiz_card(p):
+    """Карточка ОИЗ по Заявке в формате xls (открытый файл)."""
+    return render_document('oiz-card', p, 'xls', OIZ_CARD_TEMPLATE_PATH, _render_oiz_card)
+
+
+def get_inner_systems_proposals(date_from, date_to):
+    """
+    Заявки, дошедшие до шага create_user_in_inner_systems в указанный период (по дате создания задачи).
+    Доставочные адреса всех Заявок подгружаются одним запросом.
+    """
+    from michelin_bpm.main.flows import ProposalConfirmationFlow
+
+    tasks = Task.objects.filter(
+        flow_task=task_ref(ProposalConfirmationFlow.create_user_in_inner_systems),
+        created__date__gte=date_from,
+        created__date__lte=date_to,
+    )
+    return ProposalProcess.objects.filter(
+        pk__in=tasks.values('process_id')
+    ).prefetch_related(
+        Prefetch('deliveryaddress_set', queryset=DeliveryAddress.objects.order_by('pk'))
+    ).order_by('pk')
+
+
+def _render_oiz_card_data(values):
+    # Выполняется в процессе ProcessPoolExecutor, разметка компилируется один раз на процесс
+    return OIZ_CARD_LAYOUT.render_values(values).getvalue()
+
+
+class _StreamBuffer:
+    """Файлоподобный объект для zipfile без seek: накапливает записанное, чтобы отдавать архив по частям."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_export_executor = None
+_export_executor_lock = threading.Lock()
+
+
+def get_export_executor():
+    """
+    Общий на процесс пул для рендера Карточек ОИЗ (OIZ_CARDS_EXPORT_WORKERS процессов).
+    Параллельные выгрузки ставят задания в один пул, а не запускают каждая свои процессы.
+    """
+    global _export_executor
+    with _export_executor_lock:
+        if _export_executor is None:
+            _export_executor = ProcessPoolExecutor(getattr(settings, 'OIZ_CARDS_EXPORT_WORKERS', None))
+        return _export_executor
+
+
+def iter_oiz_cards_zip(proposals, executor=None):
+    """
+    Генератор ZIP-архива с Карточками ОИЗ по Заявкам, отдаёт архив частями по мере рендера.
+    Значения ячеек собираются в текущем процессе, а xls рендерятся в пуле процессов
+    (по умолчанию в общем get_export_executor).
+    """
+    proposals = list(proposals)
+    values = [OIZ_CARD_LAYOUT.get_values(p, p.deliveryaddress_set.all()) for p in proposals]
+
+    buffer = _StreamBuffer()
+    executor = executor or get_export_executor()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for p, data in zip(proposals, executor.map(_render_oiz_card_data, values)):
+            archive.writestr('proposal-info-{}.xls'.format(p.pk), data)
+            yield buffer.pop()
+    yield buffer.pop()
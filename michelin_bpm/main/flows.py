@@ -7,13 +7,13 @@ from django.contrib.auth.models import Group
 
 from viewflow import flow
 from viewflow.base import this, Flow
-from viewflow.fields import get_task_ref
 
 from michelin_bpm.main.apps import register
+from michelin_bpm.main.refs import task_ref
 from michelin_bpm.main.models import ProposalProcess, BibServeProcess
 from michelin_bpm.main.nodes import (
     StartNodeView, IfNode, SplitNode, SwitchNode, EndNode, ApproveViewNode, ViewNode, StartFunctionNode,
-    DownloadableXLSViewNode, DownloadableContractViewNode
+    DownloadableXLSViewNode, DownloadableContractViewNode, AsyncHandlerNode, get_task_snapshot
 )
 from michelin_bpm.main.views import (
     CreateProposalProcessView, ApproveView, UnblockClientView, CreateBibServerAccountView,
@@ -34,45 +34,25 @@ def has_active_correction(activation, for_step=None):
     """
     Возвращает True, если у Заявки нет ни одной активной Корректировки.
     А это значит, что заявка на данном шаге подтверждена и можно переводить её на следующий шаг.
+    Проверяется по снимку Задач процесса, см. michelin_bpm.main.nodes.TaskSnapshot.
 
     :param activation: viewflow.activation.Activation
     :param for_step: viewflow.ThisObject
     :return: boolean
     """
-    task_qs = activation.process.task_set.filter(correction__is_active=True)
     if for_step:
-        if not hasattr(for_step, 'flow_class'):
-            setattr(for_step, 'flow_class', ProposalConfirmationFlow)
-        for_step = get_task_ref(for_step)
-        task_qs = task_qs.filter(correction__for_step=for_step)
-
-    if task_qs.exists():
-        return True
-
-    return False
+        for_step = task_ref(for_step, ProposalConfirmationFlow)
+    return get_task_snapshot(activation).has_active_correction(for_step)
 
 
 def is_already_has_task(activation, task):
     # TODO MBPM-3:
     # Кажется эта функция не используется
-    if not hasattr(task, 'flow_class'):
-        setattr(task, 'flow_class', ProposalConfirmationFlow)
-
-    return activation.process.task_set.exclude(
-        status='DONE'
-    ).filter(
-        flow_task=get_task_ref(task)
-    ).exists()
+    return get_task_snapshot(activation).has_not_done(task_ref(task, ProposalConfirmationFlow))
 
 
 def is_already_done(activation, task):
-    if not hasattr(task, 'flow_class'):
-        setattr(task, 'flow_class', ProposalConfirmationFlow)
-
-    return activation.process.task_set.filter(
-        flow_task=get_task_ref(task),
-        status='DONE'
-    ).exists()
+    return get_task_snapshot(activation).is_done(task_ref(task, ProposalConfirmationFlow))
 
 
 @register
@@ -96,7 +76,7 @@ class ProposalConfirmationFlow(Flow):
         ).Next(this.create_user)
     )
 
-    create_user = flow.Handler(
+    create_user = AsyncHandlerNode(
         this.perform_create_user
     ).Next(this.add_data_by_client)
 
@@ -231,6 +211,7 @@ class ProposalConfirmationFlow(Flow):
             task_description=_('Client prints the contract'),
             task_title=_('Client prints the contract'),
             done_btn_title='Договор распечатан и отправлен',
+            prerender=True,
         ).Permission(
             auto_create=True
         ).Assign(
@@ -554,6 +535,6 @@ class BibServeFlow(Flow):
         # Проверяем, есть ли у текущей заявки процесс по созданию BibServe-аккаунта
         if hasattr(proposal, 'bibserveprocess'):
             return flow_task.flow_class.task_class._default_manager.filter(
-                flow_task=get_task_ref(flow_task),
+                flow_task=task_ref(flow_task),
                 process_id=proposal.bibserveprocess.id
             ).first()
@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 from django import forms
 from django.conf import settings
@@ -11,19 +11,20 @@ from django.utils.translation import ugettext as _
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.contrib.sites.models import Site
+from django.core import signing
 from django.urls import reverse
 from django.forms.widgets import CheckboxInput, Select, RadioSelect
 
 from django.contrib.auth.forms import PasswordResetForm, SetPasswordForm
-from reversion.models import Version
-from viewflow.fields import get_task_ref
 
-from michelin_bpm.main.models import ProposalProcess, DeliveryAddress
-from michelin_bpm.main.utils import AgoraMailerClient
+from michelin_bpm.main.models import ProposalProcess, DeliveryAddress, OutgoingMail
+from michelin_bpm.main.refs import task_ref
 
 
 User = get_user_model()
 
+VERSION_CHANGED_ERROR = 'Не удалось сохранить форму, т.к. заявка уже изменилась. Обновите страницу.'
+
 
 all_fields = [
     # rtc_fields
@@ -209,8 +210,7 @@ class SendLinkForm(PasswordResetForm):
         return active_users
 
     def send_mail_using_agora_mailer(self, to_email, from_email, context):
-        mailer = AgoraMailerClient()
-        mailer.send('michelin_bpm_invite_link', to_email, from_email, context)
+        OutgoingMail.enqueue('michelin_bpm_invite_link', [to_email], from_email, context)
 
     def save(self, domain_override=None,
              subject_template_name='main/registration/password_reset_subject.txt',
@@ -270,27 +270,56 @@ class ClientSetPasswordForm(SetPasswordForm):
         self.fields['new_password2'].label = _('Password confirmation')
 
 
+VersionToken = namedtuple('VersionToken', ['version_id', 'version_number'])
+
+
+class VersionTokenField(forms.CharField):
+    """
+    Скрытое поле с подписанной парой (id последней Версии Заявки, номер версии Заявки).
+    Проверяется без запросов к таблице Версий, возвращает VersionToken.
+    """
+    widget = forms.HiddenInput
+    signer = signing.Signer(salt='michelin_bpm.main.forms.VersionTokenField')
+    default_error_messages = {
+        'invalid': VERSION_CHANGED_ERROR,
+    }
+
+    def prepare_value(self, value):
+        if isinstance(value, VersionToken):
+            return self.signer.sign('{}:{}'.format(value.version_id or '', value.version_number))
+        return value
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        if value in self.empty_values:
+            return None
+        try:
+            version_id, version_number = self.signer.unsign(value).split(':')
+            # Без Версии Заявки форму сохранять нельзя: на неё ссылаются создаваемые Исправления
+            return VersionToken(int(version_id), int(version_number))
+        except (signing.BadSignature, ValueError):
+            raise ValidationError(self.error_messages['invalid'], code='invalid')
+
+
 class VersionFormMixin(ModelForm):
     """
     Миксин, проверяющий, не изменилась ли версия заявки, которую только что просматривал пользователь.
     Нужно использовать его в одном ViewNode с michelin_bpm.main.views.VersionViewMixin
     """
-    current_version = forms.ModelChoiceField(queryset=None, widget=forms.HiddenInput())
+    current_version = VersionTokenField()
 
     def __init__(self, *args, **kwargs):
         current_version = kwargs.pop('current_version')
         super().__init__(*args, **kwargs)
-        self.fields['current_version'].queryset = Version.objects.get_for_object(self.instance)
-        self.fields['current_version'].initial = current_version
+        self.fields['current_version'].initial = VersionToken(current_version, self.instance.version_number)
 
     def clean(self):
         self.cleaned_data = super().clean()
         # проверяем, последнюю ли версию заявки просматривал пользователь:
-        last_version = self.instance.get_last_version()
-        if last_version != self.cleaned_data['current_version']:
-            raise ValidationError(
-                'Не удалось сохранить форму, т.к. заявка уже изменилась. Обновите страницу.'
-            )
+        current_version = self.cleaned_data.get('current_version')
+        last_version_id = self.instance.get_last_version_id()
+        if last_version_id is None or current_version != VersionToken(last_version_id, self.instance.version_number):
+            raise ValidationError(VERSION_CHANGED_ERROR)
         return self.cleaned_data
 
 
@@ -322,9 +351,10 @@ class ApproveForm(GroupedFieldsMixin, VersionFormMixin, ModelForm):
             if 'is_can_answer_only' in corr_settings and corr_settings['is_can_answer_only']:
                 has_correction = False
                 if '__all__' in self.fields_corrections:
+                    for_step = task_ref(corr_settings['for_step'], self.linked_node.flow_class)
                     has_correction = bool([
                         corr for corr in self.fields_corrections['__all__']
-                        if get_task_ref(corr_settings['for_step']) == get_task_ref(corr['from_step_obj'])
+                        if for_step == task_ref(corr['from_step_obj'])
                     ])
                 if not has_correction:
                     continue
@@ -366,7 +396,7 @@ class FixMistakesForm(VersionFormMixin, ModelForm):
         # Проверяем, изменились ли те поля, к которым были указаны корректировки
         # correction_obj = self.instance.get_correction_active(for_step=get_task_ref(self.linked_node))
         # need_to_be_corrected = set(correction_obj.data.keys())
-        corrections_qs = self.instance.get_correction_active(for_step=get_task_ref(self.linked_node))
+        corrections_qs = self.instance.get_correction_active(for_step=task_ref(self.linked_node))
         # Для Клиента всегда должна быть одна активная Корретировка, т.к. он общается через Аккаунта,
         # и только Аккаунт может создавать для него Корректировки
         # TODO MBPM-3: Закрепить это на уровне констрейта в БД?
@@ -637,3 +667,16 @@ class ShowProposalForm(AddDataFormMixin, ModelForm):
     class Meta:
         model = ProposalProcess
         fields = all_fields
+
+
+class OIZCardsExportForm(forms.Form):
+    """Период выгрузки Карточек ОИЗ: дата создания задачи create_user_in_inner_systems."""
+    date_from = forms.DateField(label=l_('С'))
+    date_to = forms.DateField(label=l_('По'))
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise ValidationError(_('Start date must not be later than end date'))
+        return cleaned_data
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from reversion.models import Version
+
+from michelin_bpm.main.models import ProposalProcess
+
+
+class Command(BaseCommand):
+    """
+    Заполняет ProposalProcess.last_version и ProposalProcess.version_number у существующих Заявок.
+    Новые Версии проставляются автоматически в michelin_bpm.main.models.revision_saved.
+
+    ./manage.py backfill_last_version
+    """
+    help = 'Fill ProposalProcess.last_version and version_number for existing proposals'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help='Пересчитать last_version у всех Заявок, а не только у незаполненных')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        proposals_qs = ProposalProcess.objects.all()
+        if not options['all']:
+            proposals_qs = proposals_qs.filter(last_version__isnull=True)
+        proposal_ids = set(str(pk) for pk in proposals_qs.values_list('pk', flat=True))
+
+        versions_qs = Version.objects.get_for_model(ProposalProcess)
+        # Последняя Версия каждой Заявки одним запросом (DISTINCT ON object_id)
+        last_versions = versions_qs.order_by(
+            'object_id', '-revision__date_created'
+        ).distinct('object_id').values_list('object_id', 'pk')
+        last_versions = [(object_id, pk) for object_id, pk in last_versions if object_id in proposal_ids]
+        # Кол-во Версий каждой Заявки
+        versions_count = dict(
+            versions_qs.order_by().values('object_id').annotate(count=Count('pk')).values_list('object_id', 'count')
+        )
+
+        updated = 0
+        batch_size = options['batch_size']
+        for start in range(0, len(last_versions), batch_size):
+            with transaction.atomic():
+                for object_id, version_id in last_versions[start:start + batch_size]:
+                    version_number = versions_count.get(object_id, 0)
+                    # Пока шёл бэкфилл, revision_saved мог уже проставить более новую Версию
+                    if options['all']:
+                        guard = {'version_number__lte': version_number}
+                    else:
+                        guard = {'last_version__isnull': True}
+                    updated += ProposalProcess.objects.filter(pk=object_id, **guard).update(
+                        last_version_id=version_id,
+                        version_number=version_number
+                    )
+
+        self.stdout.write('Updated {} of {} proposals'.format(updated, len(proposal_ids)))
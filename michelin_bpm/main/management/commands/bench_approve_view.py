@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from viewflow.activation import STATUS
+from viewflow.fields import get_task_ref
+
+from michelin_bpm.main.models import ProposalProcess
+from michelin_bpm.main.refs import task_ref
+
+
+class Command(BaseCommand):
+    """
+    Замеряет полный рендер ApproveView (GET страницы выполнения задачи) для Заявки,
+    а также получение ссылки на шаг через viewflow.fields.get_task_ref и через реестр michelin_bpm.main.refs.
+
+    Задача шага node у Заявки должна быть назначена (ASSIGNED), страница открывается от имени её владельца.
+
+    ./manage.py bench_approve_view 42 --node approve_by_region_chief --repeat 50
+    """
+    help = 'Benchmark of a full ApproveView render'
+
+    def add_arguments(self, parser):
+        parser.add_argument('proposal_id', type=int)
+        parser.add_argument('--node', default='approve_by_account_manager')
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        from michelin_bpm.main.flows import ProposalConfirmationFlow
+
+        proposal = ProposalProcess.objects.get(pk=options['proposal_id'])
+        node = ProposalConfirmationFlow._meta.node(options['node'])
+        if node is None:
+            raise CommandError('Unknown node: {}'.format(options['node']))
+
+        task = proposal.task_set.filter(flow_task=task_ref(node), status=STATUS.ASSIGNED).order_by('-pk').first()
+        if task is None:
+            raise CommandError('Proposal has no assigned {} task'.format(node.name))
+
+        self.report_refs(node, options['repeat'] * 1000)
+        self.report_view(node, task, options['repeat'])
+
+    def report_refs(self, node, repeat):
+        refs = [node] + [corr_setting['for_step'] for corr_setting in node._view_args.get('show_corrections', [])]
+
+        def old():
+            for flow_task in refs:
+                if not hasattr(flow_task, 'flow_class'):
+                    flow_task.flow_class = node.flow_class
+                get_task_ref(flow_task)
+
+        def new():
+            for flow_task in refs:
+                task_ref(flow_task, node.flow_class)
+
+        self.stdout.write('--- task refs ({} per call) ---'.format(len(refs)))
+        for title, func in (('get_task_ref', old), ('task_ref', new)):
+            elapsed = timeit.timeit(func, number=repeat)
+            self.stdout.write('{}: {:.3f} us per call ({} runs)'.format(title, elapsed / repeat * 10 ** 6, repeat))
+
+    def report_view(self, node, task, repeat):
+        url = node.get_task_url(task, url_type='execute', namespace='viewflow:main:proposalconfirmation')
+        client = Client()
+        client.force_login(task.owner)
+
+        with override_settings(ALLOWED_HOSTS=['testserver']), transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(url)
+            if response.status_code != 200:
+                raise CommandError('GET {} returned {}'.format(url, response.status_code))
+
+            elapsed = timeit.timeit(lambda: client.get(url), number=repeat)
+            transaction.set_rollback(True)
+
+        self.stdout.write('--- ApproveView {} ---'.format(url))
+        self.stdout.write('{} queries per request'.format(len(queries)))
+        self.stdout.write('{:.3f} ms per request ({} runs)'.format(elapsed / repeat * 1000, repeat))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import operator
+import timeit
+from functools import reduce
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+
+from michelin_bpm.main.models import ProposalProcess, Correction
+from michelin_bpm.main.refs import task_ref
+
+
+class Command(BaseCommand):
+    """
+    Сравнивает план и время выполнения запроса Корректировок для ApproveView:
+    старый вариант (объединение отдельного кверисета на каждый шаг) и ProposalProcess.get_corrections_all.
+    Замеры пока не проводились: выигрыш от единого запроса и индекса main_correction_lookup_idx не подтверждён,
+    прогоните команду на копии рабочей БД, прежде чем на него рассчитывать.
+
+    ./manage.py bench_corrections 42 --fill 500
+    """
+    help = 'Benchmark of ProposalProcess.get_corrections_all'
+
+    def add_arguments(self, parser):
+        parser.add_argument('proposal_id', type=int)
+        parser.add_argument('--node', default='approve_by_region_chief',
+                            help='ApproveViewNode, настройки show_corrections которого используются')
+        parser.add_argument('--fill', type=int, default=0,
+                            help='Довести кол-во Корректировок у Заявки до указанного (изменения откатываются)')
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        from michelin_bpm.main.flows import ProposalConfirmationFlow
+
+        proposal = ProposalProcess.objects.get(pk=options['proposal_id'])
+        node = ProposalConfirmationFlow._meta.node(options['node'])
+
+        for_steps = [{'for_step': task_ref(node)}]
+        for corr_setting in node._view_args.get('show_corrections', []):
+            for_steps.append({
+                'for_step': task_ref(corr_setting['for_step'], node.flow_class),
+                'made_on_step': (
+                    task_ref(corr_setting['made_on_step'], node.flow_class) if ('made_on_step' in corr_setting) else None
+                )
+            })
+
+        with transaction.atomic():
+            if options['fill']:
+                self.fill(proposal, options['fill'])
+
+            self.stdout.write('Corrections: {}'.format(Correction.objects.filter(proposal=proposal).count()))
+            self.report('before', self.old_queryset(proposal, for_steps), options['repeat'])
+            self.report('after', proposal.get_corrections_all(for_steps), options['repeat'])
+
+            transaction.set_rollback(True)
+
+    def fill(self, proposal, count):
+        existing = list(Correction.objects.filter(proposal=proposal))
+        if not existing:
+            self.stderr.write('Proposal has no corrections to copy')
+            return
+        new_corrections = []
+        for i in range(count - len(existing)):
+            correction = existing[i % len(existing)]
+            values = {
+                f.attname: getattr(correction, f.attname)
+                for f in Correction._meta.concrete_fields if not f.primary_key
+            }
+            values['is_active'] = False
+            new_corrections.append(Correction(**values))
+        Correction.objects.bulk_create(new_corrections)
+
+    @staticmethod
+    def old_queryset(proposal, for_steps):
+        querysets = []
+        for for_step in for_steps:
+            if for_step.get('made_on_step'):
+                querysets.append(Correction.objects.filter(
+                    proposal=proposal,
+                    for_step=for_step['for_step'],
+                    task__flow_task=for_step['made_on_step']
+                ).order_by('-created'))
+            else:
+                querysets.append(Correction.objects.filter(
+                    proposal=proposal,
+                    for_step=for_step['for_step']
+                ).order_by('-created'))
+        return reduce(operator.or_, querysets, Correction.objects.none())
+
+    def report(self, title, queryset, repeat):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+
+        elapsed = timeit.timeit(lambda: list(queryset.all()), number=repeat)
+        self.stdout.write('--- {} ---'.format(title))
+        self.stdout.write(plan)
+        self.stdout.write('{:.3f} ms per query ({} runs)\n'.format(elapsed / repeat * 1000, repeat))
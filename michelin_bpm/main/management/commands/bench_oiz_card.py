@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import io
+import timeit
+
+import xlrd
+from xlutils.filter import process, XLRDReader, XLWTWriter
+
+from django.core.management.base import BaseCommand
+
+from michelin_bpm.main.models import ProposalProcess
+from michelin_bpm.main.utils import render_excel_template, get_excel_template
+from michelin_bpm.main.documents import OIZ_CARD_TEMPLATE_PATH, OIZ_CARD_LAYOUT
+
+
+class Command(BaseCommand):
+    """
+    Сравнивает время рендера Карточки ОИЗ (ProposalExcelDocumentView):
+    старый вариант (разбор и копирование шаблона на каждый рендер), render_excel_template с кэшем шаблона
+    и скомпилированную разметку OIZ_CARD_LAYOUT.
+    Файловый кэш документов (michelin_bpm.main.documents.render_cache) не используется.
+
+    ./manage.py bench_oiz_card 42 --count 1000
+    """
+    help = 'Benchmark of OIZ card (proposal-info.xls) rendering'
+
+    def add_arguments(self, parser):
+        parser.add_argument('proposal_id', type=int, nargs='?',
+                            help='Заявка, по которой строится Карточка. По умолчанию - первая')
+        parser.add_argument('--count', type=int, default=1000, help='Кол-во рендеров подряд')
+
+    def handle(self, *args, **options):
+        if options['proposal_id']:
+            proposal = ProposalProcess.objects.get(pk=options['proposal_id'])
+        else:
+            proposal = ProposalProcess.objects.first()
+        template_path = OIZ_CARD_TEMPLATE_PATH
+        delivery_addresses = list(proposal.deliveryaddress_set.order_by('pk'))
+        context = OIZ_CARD_LAYOUT.get_context(proposal, delivery_addresses)
+        count = options['count']
+
+        self.report('before', lambda: self.legacy_render(template_path, context), count)
+        get_excel_template.cache_clear()
+        self.report('cached template', lambda: render_excel_template(template_path, context), count)
+        self.report('compiled layout', lambda: OIZ_CARD_LAYOUT.render(proposal, delivery_addresses), count)
+
+    @staticmethod
+    def legacy_render(template_path, context):
+        rdbook = xlrd.open_workbook(template_path, formatting_info=True)
+        rdsheet = rdbook.sheet_by_name('Main list')
+        writer = XLWTWriter()
+        process(XLRDReader(rdbook, 'unknown.xls'), writer)
+        wtbook, style_list = writer.output[0][1], writer.style_list
+        wtsheet = wtbook.get_sheet('Main list')
+        for (rowx, colx), value in context.items():
+            wtsheet.write(rowx, colx, str(value or ''), style_list[rdsheet.cell_xf_index(rowx, colx)])
+        wtbook.save(io.BytesIO())
+
+    def report(self, title, func, count):
+        elapsed = timeit.timeit(func, number=count)
+        self.stdout.write('{}: {:.3f} s total, {:.3f} ms per card ({} renders)'.format(
+            title, elapsed, elapsed / count * 1000, count
+        ))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import timeit
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from michelin_bpm.main.models import ProposalProcess
+from michelin_bpm.main.views import MichelinProcessListView
+
+
+class Command(BaseCommand):
+    """
+    Сравнивает время выборки страницы списка процессов (MichelinProcessListView.get_page)
+    с простым OFFSET/LIMIT на разных смещениях.
+
+    ./manage.py bench_process_list --fill 50000
+    """
+    help = 'Benchmark of MichelinProcessListView.get_page'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fill', type=int, default=0,
+                            help='Довести кол-во Заявок до указанного (изменения откатываются)')
+        parser.add_argument('--length', type=int, default=15, help='Размер страницы')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        from michelin_bpm.main.flows import ProposalConfirmationFlow
+
+        with transaction.atomic():
+            if options['fill']:
+                self.fill(ProposalConfirmationFlow, options['fill'])
+
+            queryset = ProposalProcess.objects.filter(flow_class=ProposalConfirmationFlow).order_by('-pk')
+            total = queryset.count()
+            self.stdout.write('Proposals: {}'.format(total))
+
+            view = MichelinProcessListView()
+            view.object_list = queryset
+            length = options['length']
+            for start in sorted({0, total // 10, total // 2, max(total - length, 0)}):
+                old = timeit.timeit(lambda: list(queryset[start:start + length]), number=options['repeat'])
+                new = timeit.timeit(lambda: view.get_page(start, length), number=options['repeat'])
+                self.stdout.write('start={}: offset {:.1f} ms, get_page {:.1f} ms'.format(
+                    start, old / options['repeat'] * 1000, new / options['repeat'] * 1000
+                ))
+
+            transaction.set_rollback(True)
+
+    def fill(self, flow_class, count):
+        for i in range(count - ProposalProcess.objects.count()):
+            ProposalProcess.objects.create(
+                flow_class=flow_class,
+                client_login='bench{}'.format(i),
+                client_email='bench{}@example.com'.format(i),
+            )
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from michelin_bpm.main.documents import get_inner_systems_proposals, iter_oiz_cards_zip
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('Invalid date: {}, expected YYYY-MM-DD'.format(value))
+
+
+class Command(BaseCommand):
+    """
+    Выгружает в ZIP-архив Карточки ОИЗ по всем Заявкам, дошедшим до create_user_in_inner_systems за период.
+
+    ./manage.py export_oiz_cards 2018-01-01 2018-01-31 -o cards.zip
+    """
+    help = 'Export OIZ cards of proposals that reached create_user_in_inner_systems in a date range'
+
+    def add_arguments(self, parser):
+        parser.add_argument('date_from', type=parse_date)
+        parser.add_argument('date_to', type=parse_date)
+        parser.add_argument('-o', '--output', default='proposal-info.zip')
+        parser.add_argument('--workers', type=int, default=None, help='Кол-во процессов для рендера')
+
+    def handle(self, *args, **options):
+        proposals = list(get_inner_systems_proposals(options['date_from'], options['date_to']))
+        with ProcessPoolExecutor(options['workers']) as executor, open(options['output'], 'wb') as f:
+            for chunk in iter_oiz_cards_zip(proposals, executor=executor):
+                f.write(chunk)
+        self.stdout.write('Exported {} cards to {}'.format(len(proposals), options['output']))
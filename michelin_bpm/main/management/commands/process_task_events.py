@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from michelin_bpm.main.models import TaskEvent
+from michelin_bpm.main.signals import process_task_event, task_event_failed
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Обрабатывает события по задачам (TaskEvent), записанные в транзакциях viewflow.
+    Несколько воркеров могут работать параллельно: события разбираются по одному через SELECT ... FOR UPDATE SKIP LOCKED.
+
+    ./manage.py process_task_events --loop
+    """
+    help = 'Process task events recorded by viewflow transactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', dest='loop',
+                            help='Не завершаться, а ждать новые события')
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--sleep', type=float, default=2, help='Пауза между проверками очереди, сек.')
+
+    def handle(self, *args, **options):
+        self.max_attempts = getattr(settings, 'TASK_EVENTS_MAX_ATTEMPTS', 5)
+        self.retry_delay = getattr(settings, 'TASK_EVENTS_RETRY_DELAY', 30)
+        while True:
+            processed = self.process_batch(options['batch_size'])
+            if processed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+    def process_batch(self, batch_size):
+        """
+        Обрабатывает до batch_size событий. Возвращает кол-во обработанных событий.
+        Каждое событие забирается и обрабатывается в своей транзакции, чтобы блокировки
+        (в т.ч. строк процессов в run_job) не держались до конца всей пачки.
+        """
+        processed = 0
+        while processed < batch_size:
+            if not self.process_next():
+                break
+            processed += 1
+        return processed
+
+    def process_next(self):
+        """Забирает и обрабатывает одно событие. Возвращает False, если очередь пуста."""
+        with transaction.atomic():
+            event = TaskEvent.objects.select_for_update(skip_locked=True).filter(
+                attempts__lt=self.max_attempts,
+                next_attempt_at__lte=timezone.now()
+            ).select_related('task').order_by('pk').first()
+            if event is None:
+                return False
+
+            try:
+                with transaction.atomic():
+                    process_task_event(event)
+            except Exception as exc:
+                logger.exception('Task event #%s failed', event.pk)
+                self.record_failure(event, exc)
+            else:
+                event.delete()
+        return True
+
+    def record_failure(self, event, exc):
+        event.attempts += 1
+        event.last_error = str(exc)
+        # экспоненциальная задержка перед следующей попыткой
+        event.next_attempt_at = timezone.now() + timedelta(seconds=self.retry_delay * 2 ** (event.attempts - 1))
+        event.save(update_fields=['attempts', 'next_attempt_at', 'last_error'])
+
+        if event.attempts >= self.max_attempts:
+            # Событие остаётся в очереди (видно в админке), а задача переводится в ошибку
+            try:
+                with transaction.atomic():
+                    task_event_failed(event)
+            except Exception:
+                logger.exception('Could not mark task #%s of event #%s as failed', event.task_id, event.pk)
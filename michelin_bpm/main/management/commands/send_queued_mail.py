@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import time
+import logging
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from michelin_bpm.main.models import OutgoingMail
+from michelin_bpm.main.utils import AgoraMailerClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """
+    Отправляет письма из очереди OutgoingMail через мейлер.
+    Несколько воркеров могут работать параллельно: письма разбираются через SELECT ... FOR UPDATE SKIP LOCKED
+    и помечаются как отправляемые, отправка идёт вне транзакции.
+
+    ./manage.py send_queued_mail --loop
+    """
+    help = 'Send queued mails through the mailer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', dest='loop',
+                            help='Не завершаться, а ждать новые письма')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'MAIL_QUEUE_BATCH_SIZE', 50))
+        parser.add_argument('--sleep', type=float, default=5, help='Пауза между проверками очереди, сек.')
+
+    def handle(self, *args, **options):
+        self.max_attempts = getattr(settings, 'MAIL_QUEUE_MAX_ATTEMPTS', 5)
+        self.retry_delay = getattr(settings, 'MAIL_QUEUE_RETRY_DELAY', 60)
+        self.claim_timeout = getattr(settings, 'MAIL_QUEUE_CLAIM_TIMEOUT', 600)
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        mailer = AgoraMailerClient(session=session)
+
+        try:
+            while True:
+                processed = self.send_batch(mailer, options['batch_size'])
+                if processed:
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+        finally:
+            session.close()
+
+    def send_batch(self, mailer, batch_size):
+        """Отправляет одну пачку писем. Возвращает кол-во обработанных писем."""
+        mails = self.claim_batch(batch_size)
+        for mail in mails:
+            self.send_mail(mailer, mail)
+        return len(mails)
+
+    def claim_batch(self, batch_size):
+        """
+        Короткой транзакцией забирает пачку писем и помечает их как отправляемые (SENDING),
+        сами запросы к мейлеру идут уже без транзакции и блокировок.
+        Если воркер упадёт, не дописав результат, письмо вернётся в очередь через MAIL_QUEUE_CLAIM_TIMEOUT секунд.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            mails = list(
+                OutgoingMail.objects.select_for_update(skip_locked=True).filter(
+                    status__in=[OutgoingMail.NEW, OutgoingMail.SENDING],
+                    next_attempt_at__lte=now
+                ).order_by('pk')[:batch_size]
+            )
+            OutgoingMail.objects.filter(pk__in=[mail.pk for mail in mails]).update(
+                status=OutgoingMail.SENDING,
+                next_attempt_at=now + timedelta(seconds=self.claim_timeout)
+            )
+        return mails
+
+    def send_mail(self, mailer, mail):
+        mail.attempts += 1
+        mail.status = OutgoingMail.NEW
+        try:
+            mailer.send_encoded(mail.slug, mail.recipient, mail.from_email, mail.data)
+        except Exception as exc:
+            mail.last_error = str(exc)
+            if mail.attempts >= self.max_attempts:
+                mail.status = OutgoingMail.FAILED
+                logger.error('Mail #%s to %s failed: %s', mail.pk, mail.recipient, exc)
+            else:
+                # экспоненциальная задержка перед следующей попыткой
+                mail.next_attempt_at = timezone.now() + timedelta(seconds=self.retry_delay * 2 ** (mail.attempts - 1))
+                logger.warning('Mail #%s to %s will be retried: %s', mail.pk, mail.recipient, exc)
+        else:
+            mail.status = OutgoingMail.SENT
+            mail.sent = timezone.now()
+        mail.save(update_fields=['attempts', 'status', 'sent', 'next_attempt_at', 'last_error'])
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_auto_20180307_0919'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='correction',
+            index=models.Index(fields=['proposal', 'for_step', 'is_active', 'created'], name='main_correction_lookup_idx'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 11:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_proposalprocess_last_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proposalprocess',
+            name='version_number',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Номер версии заявки'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('viewflow', '0006_i18n'),
+        ('main', '0019_outgoingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('TASK_STARTED', 'Задача создана')], max_length=50, verbose_name='Тип события')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Кол-во попыток обработки')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Последняя ошибка')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='viewflow.Task', verbose_name='Задача')),
+            ],
+            options={
+                'verbose_name': 'Событие по задаче',
+                'verbose_name_plural': 'События по задачам',
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 15:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0021_taskevent_prerender'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContractCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField(unique=True, verbose_name='Год')),
+                ('last_number', models.PositiveIntegerField(default=0, verbose_name='Последний выданный номер')),
+            ],
+            options={
+                'verbose_name': 'Счётчик номеров договоров',
+                'verbose_name_plural': 'Счётчики номеров договоров',
+            },
+        ),
+    ]
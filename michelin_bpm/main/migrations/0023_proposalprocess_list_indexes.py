@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 16:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_contractcounter'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proposalprocess',
+            index=models.Index(fields=['client', 'process_ptr'], name='main_proposal_client_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='proposalprocess',
+            index=models.Index(fields=['acs', 'process_ptr'], name='main_proposal_acs_idx'),
+        ),
+    ]
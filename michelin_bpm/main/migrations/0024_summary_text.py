@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 16:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.template import Template, Context
+
+
+# summary_template потоков на момент создания миграции
+PROPOSAL_SUMMARY_TEMPLATE = '{{ process.company_name }} {{ process.city }}'
+BIBSERVE_SUMMARY_TEMPLATE = '{{ process.proposal.company_name }} {{ process.proposal.city }}'
+
+
+def fill_summary_text(apps, schema_editor):
+    for model_name, template_string, related in (
+        ('ProposalProcess', PROPOSAL_SUMMARY_TEMPLATE, []),
+        ('BibServeProcess', BIBSERVE_SUMMARY_TEMPLATE, ['proposal']),
+    ):
+        model = apps.get_model('main', model_name)
+        template = Template(template_string)
+        for process in model.objects.select_related(*related).iterator():
+            model.objects.filter(pk=process.pk).update(
+                summary_text=template.render(Context({'process': process}))
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_proposalprocess_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proposalprocess',
+            name='summary_text',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=512, verbose_name='Краткое описание'),
+        ),
+        migrations.AddField(
+            model_name='bibserveprocess',
+            name='summary_text',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=512, verbose_name='Краткое описание'),
+        ),
+        migrations.RunPython(fill_summary_text, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 17:15
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+def fill_active_correction_steps(apps, schema_editor):
+    ProposalProcess = apps.get_model('main', 'ProposalProcess')
+    Correction = apps.get_model('main', 'Correction')
+
+    steps = defaultdict(set)
+    active_corrections = Correction.objects.filter(
+        is_active=True, for_step__isnull=False
+    ).order_by().values_list('proposal_id', 'for_step').distinct()
+    for proposal_id, for_step in active_corrections:
+        steps[proposal_id].add(for_step)
+
+    for proposal_id, for_steps in steps.items():
+        ProposalProcess.objects.filter(pk=proposal_id).update(active_correction_steps=sorted(for_steps))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0024_summary_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proposalprocess',
+            name='active_correction_steps',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), blank=True, default=list, editable=False, size=None, verbose_name='Шаги с активными корректировками'),
+        ),
+        migrations.RunPython(fill_active_correction_steps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0025_proposalprocess_active_correction_steps'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='taskevent',
+            name='kind',
+            field=models.CharField(choices=[('TASK_STARTED', 'Задача создана'), ('PRERENDER_DOCUMENT', 'Подготовка документа'), ('RUN_JOB', 'Выполнение фоновой задачи')], max_length=50, verbose_name='Тип события'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 20:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0026_taskevent_run_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='taskevent',
+            name='kind',
+            field=models.CharField(choices=[('TASK_STARTED', 'Задача создана'), ('PRERENDER_DOCUMENT', 'Подготовка документа'), ('RUN_JOB', 'Выполнение фоновой задачи'), ('START_BIBSERVE', 'Запуск процесса BibServe')], max_length=50, verbose_name='Тип события'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-18 21:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0028_taskevent_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outgoingmail',
+            name='status',
+            field=models.CharField(choices=[('NEW', 'Ожидает отправки'), ('SENDING', 'Отправляется'), ('SENT', 'Отправлено'), ('FAILED', 'Не удалось отправить')], default='NEW', max_length=10, verbose_name='Статус'),
+        ),
+    ]
@@ -1,10 +1,15 @@
 # -*- coding: utf-8 -*-
 import json
-from django.db import models
+import operator
+from functools import reduce, lru_cache
+
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import JSONField, ArrayField
 from django.utils.translation import ugettext_lazy as l_, ugettext as _
 from django.dispatch import receiver
+from django.template import Template, Context
+from django.utils import timezone
 
 import reversion
 from reversion.models import Version
@@ -12,13 +17,66 @@ from reversion.signals import post_revision_commit
 from viewflow.activation import STATUS_CHOICES
 from viewflow.models import Process
 
+from michelin_bpm.main.utils import LRUCache, AgoraMailerClient
 
-@reversion.register()
-class ProposalProcess(Process):
+
+# Раскодированные данные Версий Заявок, см. ProposalProcess.get_version_data
+version_data_cache = LRUCache(maxsize=getattr(settings, 'VERSION_DATA_CACHE_SIZE', 1024))
+
+
+@lru_cache(maxsize=None)
+def get_summary_template(template_string):
+    return Template(template_string)
+
+
+class CompiledSummaryMixin:
+    """
+    Краткое описание процесса (Process.summary) хранится в поле summary_text и обновляется при сохранении,
+    поэтому списки и уведомления не рендерят summary_template.
+    Сам summary_template компилируется один раз на процесс, а не при каждом рендере.
+    """
+
+    def render_summary(self):
+        if self.flow_class and self.flow_class.process_class == type(self):
+            return get_summary_template(self.flow_class.summary_template).render(
+                Context({'process': self, 'flow_class': self.flow_class})
+            )
+        return super().summary()
+
+    def refresh_summary_text(self):
+        """Обновляет summary_text (без сохранения). Возвращает True, если описание изменилось."""
+        summary_text = self.render_summary()
+        changed = summary_text != self.summary_text
+        self.summary_text = summary_text
+        return changed
+
+    def summary(self):
+        if self.summary_text:
+            return self.summary_text
+        return self.render_summary()
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.refresh_summary_text() and update_fields is not None and 'summary_text' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['summary_text']
+        super().save(*args, **kwargs)
+
+
+@reversion.register(exclude=['last_version', 'version_number', 'active_correction_steps'])
+class ProposalProcess(CompiledSummaryMixin, Process):
 
     class Meta:
         verbose_name = l_('Заявка')
         verbose_name_plural = l_('Заявки')
+        indexes = [
+            # Списки процессов клиента и ACS, см. MichelinProcessListView
+            models.Index(fields=['client', 'process_ptr'], name='main_proposal_client_idx'),
+            models.Index(fields=['acs', 'process_ptr'], name='main_proposal_acs_idx'),
+        ]
+
+    VERSION_TRACKING_FIELDS = ('last_version', 'version_number')
+    # Поля, которые обновляются отдельными UPDATE-запросами и не перезаписываются при save()
+    DENORMALIZED_FIELDS = VERSION_TRACKING_FIELDS + ('active_correction_steps',)
 
     OPENING = 0
     CHANGING = 1
@@ -107,6 +165,42 @@ class ProposalProcess(Process):
         on_delete=models.CASCADE, verbose_name=l_('Регистрируемый клиент'),
         related_name='clients_proposals'
     )
+    summary_text = models.CharField(
+        l_('Краткое описание'), max_length=512, blank=True, default='', editable=False, db_index=True
+    )
+    # last_version и version_number обновляются только в receiver'е revision_saved, см. ProposalProcess.save
+    last_version = models.ForeignKey(
+        'reversion.Version', blank=True, null=True, editable=False,
+        on_delete=models.SET_NULL, verbose_name=l_('Последняя версия заявки'),
+        related_name='+'
+    )
+    version_number = models.PositiveIntegerField(l_('Номер версии заявки'), default=0, editable=False)
+    # Шаги (ссылки viewflow.fields.get_task_ref), для которых есть активные Корректировки.
+    # Обновляется в refresh_active_correction_steps, используется в условиях шлюзов, см. has_active_correction
+    active_correction_steps = ArrayField(
+        models.CharField(max_length=255), blank=True, default=list, editable=False,
+        verbose_name=l_('Шаги с активными корректировками')
+    )
+
+    def save(self, *args, **kwargs):
+        # Сохранение уже существующей Заявки не должно затирать last_version, version_number
+        # и active_correction_steps значениями, которые были загружены раньше
+        if self.pk and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DENORMALIZED_FIELDS
+            ]
+        old_summary_text = self.summary_text
+        super().save(*args, **kwargs)
+
+        # Описание BibServe-процесса строится по Заявке
+        if self.summary_text != old_summary_text:
+            for bibserve_process in BibServeProcess.objects.filter(proposal=self):
+                bibserve_process.proposal = self
+                if bibserve_process.refresh_summary_text():
+                    BibServeProcess.objects.filter(pk=bibserve_process.pk).update(
+                        summary_text=bibserve_process.summary_text
+                    )
 
     @property
     def operation_type_name(self):
@@ -118,39 +212,36 @@ class ProposalProcess(Process):
 
     def get_corrections_all(self, for_steps):
         """
-        TODO MBPM-3:
-        Акктуализировать докстринги, а именно переменную for_steps
-
-        Возвращает кверисет всех Корректировок (main.Correction) которые есть для указанной Задачи у текущей Заявки.
+        Возвращает кверисет всех Корректировок (main.Correction) которые есть для указанных Задач у текущей Заявки.
 
-        :param for_step: list of string, название шага viewflow.models.Task.flow_task.
+        :param for_steps: list of dict вида {'for_step': string, 'made_on_step': string or None},
+                            for_step -- для какого шага создана Корректировка,
+                            made_on_step -- на каком шаге она создана (если None, то на любом).
                             Строковое имя шага можно получить, использую функцию viewflow.fields.get_task_ref
         :return: queryset of michelin.main.models.Correction
         """
-        # {
-        #     'for_step': get_task_ref(corr_setting['for_step']),
-        #     'made_on': get_task_ref(corr_setting['made_on']) if ('made_on' in corr_setting) else None
-        # }
-        # corrections_qs = Correction.objects.filter(proposal=self)
-
-        corrections_qs = Correction.objects.none()
+        # Один запрос вида
+        #   proposal_id = ... AND (for_step IN (...) OR (for_step = ... AND task.flow_task = ...) OR ...)
+        # вместо объединения отдельного кверисета на каждый шаг.
+        plain_steps = []
+        conditions = []
         for for_step in for_steps:
             if 'made_on_step' in for_step and for_step['made_on_step']:
-                corrections_qs = corrections_qs | Correction.objects.filter(
-                    proposal=self,
-                    for_step=for_step['for_step'],
-                    task__flow_task=for_step['made_on_step']
-                ).order_by('-created')
+                conditions.append(
+                    models.Q(for_step=for_step['for_step'], task__flow_task=for_step['made_on_step'])
+                )
             else:
-                corrections_qs = corrections_qs | Correction.objects.filter(
-                    proposal=self,
-                    for_step=for_step['for_step']
-                ).order_by('-created')
-        return corrections_qs
-        # return Correction.objects.filter(
-        #     proposal=self,
-        #     for_step__in=for_steps
-        # ).order_by('-created')
+                plain_steps.append(for_step['for_step'])
+        if plain_steps:
+            conditions.append(models.Q(for_step__in=plain_steps))
+
+        if not conditions:
+            return Correction.objects.none()
+
+        return Correction.objects.filter(
+            reduce(operator.or_, conditions),
+            proposal=self
+        ).order_by('-created')
 
     def get_correction_active(self, for_step=None):
         """
@@ -167,6 +258,29 @@ class ProposalProcess(Process):
             correction_qs = correction_qs.filter(for_step=for_step)
         return correction_qs
 
+    def refresh_active_correction_steps(self):
+        """
+        Пересчитывает active_correction_steps по активным Корректировкам и сохраняет в БД.
+        Вызывается везде, где Корректировки создаются или деактивируются.
+        """
+        self.active_correction_steps = sorted(set(
+            Correction.objects.filter(
+                proposal=self, is_active=True, for_step__isnull=False
+            ).values_list('for_step', flat=True)
+        ))
+        ProposalProcess.objects.filter(pk=self.pk).update(active_correction_steps=self.active_correction_steps)
+
+    def has_active_correction(self, for_step=None):
+        """
+        Возвращает True, если у Заявки есть активная Корректировка для указанного шага (или для любого шага).
+        Проверяется по active_correction_steps, без запросов к БД.
+
+        :param for_step: string, ссылка на шаг, см. viewflow.fields.get_task_ref
+        """
+        if for_step:
+            return for_step in self.active_correction_steps
+        return bool(self.active_correction_steps)
+
     def get_correction_last(self, for_step):
         """
         Возвращает последнюю Корректировку (main.Correction) для указанной Задачи у текущей Заявки.
@@ -198,14 +312,45 @@ class ProposalProcess(Process):
         :return: viewflow.models.Version
         """
         if not for_step:
+            if self.last_version_id:
+                return self.last_version
             return Version.objects.get_for_object(self).order_by('-revision__date_created').first()
         else:
             correction_obj = self.get_correction_last(for_step=for_step)
             if correction_obj:
                 return correction_obj.reviewed_version
 
+    def get_last_version_id(self):
+        """
+        Возвращает id последней Версии (reversion.Version) Заявки.
+        Берётся из last_version без запроса к БД. Для Заявок, у которых last_version ещё не заполнен
+        (см. manage.py backfill_last_version), Версия ищется запросом.
+        """
+        if self.last_version_id:
+            return self.last_version_id
+        return Version.objects.get_for_object(self).order_by(
+            '-revision__date_created'
+        ).values_list('pk', flat=True).first()
+
     @staticmethod
-    def get_diff_fields(current_state, version, fields):
+    def get_version_data(version):
+        """
+        Возвращает dict вида {field_name: field_value} с данными Заявки, сохранёнными в Версии.
+        Версии не меняются, поэтому раскодированные данные кэшируются по pk Версии на весь процесс.
+        Возвращаемый dict общий для всех вызовов, изменять его нельзя.
+
+        :param version: reversion.models.Version
+        :return: dict
+        """
+        def decode():
+            return json.loads(version.serialized_data)[0]['fields']
+
+        if version.pk is None:
+            return decode()
+        return version_data_cache.get_or_set(version.pk, decode)
+
+    @classmethod
+    def get_diff_fields(cls, current_state, version, fields):
         """
         Возвращает поля, которые различаются с переданной версией.
 
@@ -213,7 +358,17 @@ class ProposalProcess(Process):
         :param version: viewflow.models.Version, версия, с которой сравнивается current_state
         :fields: iterable, поля, по которым идёт сравнение
         """
-        version_data = json.loads(version.serialized_data)[0]['fields']
+        return cls.get_diff_data(current_state, cls.get_version_data(version), fields)
+
+    @staticmethod
+    def get_diff_data(current_state, version_data, fields):
+        """
+        То же, что и get_diff_fields, но сравнение идёт с уже раскодированными данными Версии.
+
+        :param current_state: dict вида {field_name: field_value}, текущие значения полей Заявки
+        :param version_data: dict вида {field_name: field_value}, см. get_version_data
+        :fields: iterable, поля, по которым идёт сравнение
+        """
         diff_fields = {}
         for field in fields:
             if field in current_state and current_state[field] != version_data[field]:
@@ -265,7 +420,7 @@ class DeliveryAddress(models.Model):
 
 
 @reversion.register()
-class BibServeProcess(Process):
+class BibServeProcess(CompiledSummaryMixin, Process):
 
     class Meta:
         verbose_name = l_('BibServe аккаунт')
@@ -275,6 +430,9 @@ class BibServeProcess(Process):
     login = models.CharField(l_('Login'), max_length=255, null=True, blank=True)
     password = models.CharField(l_('Password'), max_length=255, null=True, blank=True)
     is_allowed_to_activate = models.BooleanField(l_('Is allowed to activate'), default=False)
+    summary_text = models.CharField(
+        l_('Краткое описание'), max_length=512, blank=True, default='', editable=False, db_index=True
+    )
 
 
 class Correction(models.Model):
@@ -288,6 +446,9 @@ class Correction(models.Model):
     class Meta:
         verbose_name = l_('Корректировка')
         verbose_name_plural = l_('Корректировка')
+        indexes = [
+            models.Index(fields=['proposal', 'for_step', 'is_active', 'created'], name='main_correction_lookup_idx'),
+        ]
 
     proposal = models.ForeignKey(
         ProposalProcess,
@@ -337,13 +498,167 @@ class Correction(models.Model):
     )
 
 
+class OutgoingMail(models.Model):
+    """
+    Очередь писем, отправляемых через мейлер (michelin_bpm.main.utils.AgoraMailerClient).
+    Письма добавляются в очередь после коммита транзакции, см. OutgoingMail.enqueue,
+    и отправляются воркером: ./manage.py send_queued_mail
+    """
+    class Meta:
+        verbose_name = l_('Исходящее письмо')
+        verbose_name_plural = l_('Исходящие письма')
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='main_outgoingmail_queue_idx'),
+        ]
+
+    NEW = 'NEW'
+    SENDING = 'SENDING'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+
+    STATUSES = (
+        (NEW, l_('Ожидает отправки')),
+        (SENDING, l_('Отправляется')),
+        (SENT, l_('Отправлено')),
+        (FAILED, l_('Не удалось отправить')),
+    )
+
+    slug = models.CharField(l_('Шаблон письма'), max_length=255)
+    recipient = models.CharField(l_('Получатель'), max_length=255)
+    from_email = models.CharField(l_('Отправитель'), max_length=255)
+    data = models.TextField(l_('Контекст письма'))
+    status = models.CharField(l_('Статус'), max_length=10, choices=STATUSES, default=NEW)
+    attempts = models.PositiveIntegerField(l_('Кол-во попыток отправки'), default=0)
+    next_attempt_at = models.DateTimeField(l_('Следующая попытка'), default=timezone.now)
+    last_error = models.TextField(l_('Последняя ошибка'), blank=True, default='')
+    created = models.DateTimeField(l_('Дата создания'), auto_now_add=True)
+    sent = models.DateTimeField(l_('Дата отправки'), null=True, blank=True)
+
+    def __str__(self):
+        return '{} -> {}'.format(self.slug, self.recipient)
+
+    @classmethod
+    def enqueue(cls, slug, recipients, from_email, context):
+        """
+        Ставит письма в очередь на отправку после коммита текущей транзакции.
+        Если транзакция откатится, письма не будут отправлены.
+
+        :param slug: string, slug шаблона письма в мейлере
+        :param recipients: list of string, email'ы получателей
+        :param from_email: string
+        :param context: dict, контекст письма
+        """
+        data = AgoraMailerClient.encode_context(context)
+        mails = [
+            cls(slug=slug, recipient=recipient, from_email=from_email, data=data)
+            for recipient in recipients
+        ]
+        if mails:
+            transaction.on_commit(lambda: cls.objects.bulk_create(mails))
+
+
+class TaskEvent(models.Model):
+    """
+    Событие по задаче viewflow (viewflow.models.Task).
+    Записывается в той же транзакции, что и задача, а обрабатывается после коммита воркером:
+    ./manage.py process_task_events
+    См. michelin_bpm.main.signals.task_created
+    """
+    class Meta:
+        verbose_name = l_('Событие по задаче')
+        verbose_name_plural = l_('События по задачам')
+
+    TASK_STARTED = 'TASK_STARTED'
+    PRERENDER_DOCUMENT = 'PRERENDER_DOCUMENT'
+    RUN_JOB = 'RUN_JOB'
+    START_BIBSERVE = 'START_BIBSERVE'
+
+    KINDS = (
+        (TASK_STARTED, l_('Задача создана')),
+        (PRERENDER_DOCUMENT, l_('Подготовка документа')),
+        (RUN_JOB, l_('Выполнение фоновой задачи')),
+        (START_BIBSERVE, l_('Запуск процесса BibServe')),
+    )
+
+    task = models.ForeignKey('viewflow.Task', on_delete=models.CASCADE, verbose_name=l_('Задача'))
+    kind = models.CharField(l_('Тип события'), max_length=50, choices=KINDS)
+    created = models.DateTimeField(l_('Дата создания'), auto_now_add=True)
+    attempts = models.PositiveIntegerField(l_('Кол-во попыток обработки'), default=0)
+    next_attempt_at = models.DateTimeField(l_('Следующая попытка'), default=timezone.now)
+    last_error = models.TextField(l_('Последняя ошибка'), blank=True, default='')
+
+    def __str__(self):
+        return '{} #{}'.format(self.kind, self.task_id)
+
+
+class ContractCounter(models.Model):
+    """
+    Счётчик номеров Договоров по годам. Номер Договора - "<номер>/<год>".
+    Номера выдаются через ContractCounter.allocate под блокировкой строки года,
+    поэтому параллельные запросы не получат один и тот же номер.
+    """
+    class Meta:
+        verbose_name = l_('Счётчик номеров договоров')
+        verbose_name_plural = l_('Счётчики номеров договоров')
+
+    year = models.PositiveIntegerField(l_('Год'), unique=True)
+    last_number = models.PositiveIntegerField(l_('Последний выданный номер'), default=0)
+
+    def __str__(self):
+        return '{}/{}'.format(self.last_number, self.year)
+
+    @staticmethod
+    def get_max_contract_number(year):
+        """Максимальный номер среди уже выданных за год Договоров (для Договоров, выданных до появления счётчика)."""
+        max_number = 0
+        contract_numbers = ProposalProcess.objects.filter(
+            contract_date__year=year
+        ).exclude(
+            contract_number=None
+        ).values_list('contract_number', flat=True)
+        for contract_number in contract_numbers:
+            try:
+                max_number = max(max_number, int(contract_number.split('/')[0]))
+            except ValueError:
+                pass
+        return max_number
+
+    @classmethod
+    def allocate(cls, year):
+        """
+        Выдаёт следующий номер Договора за год. Строка счётчика блокируется до конца транзакции.
+        Счётчик года создаётся при первом обращении и начинается с максимального из уже выданных номеров.
+        """
+        with transaction.atomic():
+            try:
+                counter = cls.objects.select_for_update().get(year=year)
+            except cls.DoesNotExist:
+                # Максимальный номер ищется только при создании счётчика года
+                try:
+                    with transaction.atomic():
+                        counter = cls.objects.create(year=year, last_number=cls.get_max_contract_number(year))
+                except IntegrityError:
+                    # Счётчик года одновременно создал другой запрос
+                    counter = cls.objects.select_for_update().get(year=year)
+            counter.last_number += 1
+            counter.save(update_fields=['last_number'])
+        return counter.last_number
+
+
 @receiver(post_revision_commit)
 def revision_saved(sender, revision, versions, **kwargs):
     """
+    Запоминаем у Заявки её последнюю Версию.
     Деактивируем объект Корректировки и добавляем к ней информацию о том,
     в какой версии Заявки исправлена Корректировка.
     """
     proposal_versions = [version for version in versions if version._model == ProposalProcess]
+    for version in proposal_versions:
+        ProposalProcess.objects.filter(pk=version.object_id).update(
+            last_version=version,
+            version_number=models.F('version_number') + 1
+        )
+
     if proposal_versions:
         saved_proposal_version = proposal_versions[0]
         # Для Клиента всегда должна быть одна активная Корретировка, т.к. он общается через Аккаунта,
@@ -354,8 +669,10 @@ def revision_saved(sender, revision, versions, **kwargs):
         # Если новую версию создал Клиент, то это значит, что он внёс изменения в Заявку и мы можем
         # деактивировать предыдущую Корректировку от Аккаунта
         if saved_proposal_version.object.client == saved_proposal_version.revision.user:
-            correction_obj = saved_proposal_version.object.get_correction_active().first()
+            proposal = saved_proposal_version.object
+            correction_obj = proposal.get_correction_active().first()
             if correction_obj:
                 correction_obj.is_active = False
                 correction_obj.fixed_in_version = saved_proposal_version
                 correction_obj.save()
+                proposal.refresh_active_correction_steps()
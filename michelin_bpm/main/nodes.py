@@ -6,9 +6,14 @@ from django.urls import reverse
 
 from viewflow import ThisObject
 from viewflow.flow import nodes
-from viewflow.activation import STATUS
+from viewflow.models import Process
+from viewflow.activation import STATUS, Activation, AbstractJobActivation
+from viewflow.nodes.ifgate import IfActivation
+from viewflow.nodes.switch import SwitchActivation
 
+from michelin_bpm.main.models import TaskEvent
 from michelin_bpm.main.views import ProposalExcelDocumentView, ProposalPdfContractView
+from michelin_bpm.main.documents import render_contract, render_oiz_card
 
 
 class LinkedNodeMixin:
@@ -40,6 +45,60 @@ class TranslatedNodeMixin:
         return str(name)
 
 
+class TaskSnapshot:
+    """
+    Статусы всех Задач процесса, загруженные одним запросом, и шаги с активными Корректировками.
+    Условия гейтвеев в flows.py отвечают по снимку, а не делают каждое свой запрос к task_set.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.statuses = {}
+        for flow_task, status in process.task_set.values_list('flow_task', 'status'):
+            self.statuses.setdefault(flow_task, set()).add(status)
+        if hasattr(process, 'active_correction_steps'):
+            # Процесс загружен в начале запроса, а параллельная ветка могла с тех пор изменить Корректировки
+            process.refresh_from_db(fields=['active_correction_steps'])
+
+    def is_done(self, ref):
+        """Есть ли у процесса завершённая Задача шага ref."""
+        return STATUS.DONE in self.statuses.get(ref, ())
+
+    def has_not_done(self, ref):
+        """Есть ли у процесса незавершённая Задача шага ref."""
+        return any(status != STATUS.DONE for status in self.statuses.get(ref, ()))
+
+    def has_active_correction(self, ref=None):
+        """Есть ли активная Корректировка для шага ref (или для любого шага), см. ProposalProcess.has_active_correction."""
+        return self.process.has_active_correction(ref)
+
+
+def get_task_snapshot(activation):
+    """Возвращает TaskSnapshot процесса, закешированный на activation до создания ей новых Задач."""
+    snapshot = getattr(activation, '_task_snapshot', None)
+    if snapshot is None:
+        snapshot = activation._task_snapshot = TaskSnapshot(activation.process)
+    return snapshot
+
+
+class TaskSnapshotIfActivation(IfActivation):
+
+    @Activation.status.super()
+    def activate_next(self):
+        """После создания следующих Задач снимок устаревает."""
+        super(TaskSnapshotIfActivation, self).activate_next.original()
+        self._task_snapshot = None
+
+
+class TaskSnapshotSwitchActivation(SwitchActivation):
+
+    @Activation.status.super()
+    def activate_next(self):
+        """После создания следующих Задач снимок устаревает."""
+        super(TaskSnapshotSwitchActivation, self).activate_next.original()
+        self._task_snapshot = None
+
+
 class StartNodeView(LinkedNodeMixin, TranslatedNodeMixin, nodes.Start):
     pass
 
@@ -49,7 +108,7 @@ class StartFunctionNode(TranslatedNodeMixin, nodes.StartFunction):
 
 
 class IfNode(TranslatedNodeMixin, nodes.If):
-    pass
+    activation_class = TaskSnapshotIfActivation
 
 
 class SplitNode(TranslatedNodeMixin, nodes.Split):
@@ -57,7 +116,67 @@ class SplitNode(TranslatedNodeMixin, nodes.Split):
 
 
 class SwitchNode(TranslatedNodeMixin, nodes.Switch):
-    pass
+    activation_class = TaskSnapshotSwitchActivation
+
+
+class AsyncHandlerActivation(AbstractJobActivation):
+    """
+    Активация AsyncHandlerNode.
+    Задача ставится в очередь событием TaskEvent.RUN_JOB в той же транзакции, что и сама задача,
+    а обработчик выполняет воркер ./manage.py process_task_events, см. AsyncHandlerNode.run_job.
+    """
+
+    def run_async(self):
+        TaskEvent.objects.create(task=self.task, kind=TaskEvent.RUN_JOB)
+
+
+class AsyncHandlerNode(TranslatedNodeMixin, nodes.AbstractJob):
+    """
+    Вариант flow.Handler, обработчик которого выполняется не в запросе, а фоновым воркером.
+    Процесс переходит к следующему шагу, когда обработчик успешно выполнился.
+    Если обработчик упал, транзакция откатывается и воркер повторит попытку с нарастающей задержкой.
+    После TASK_EVENTS_MAX_ATTEMPTS неудач задача переводится в статус ERROR, см. job_failed.
+
+    create_user = AsyncHandlerNode(this.perform_create_user).Next(this.add_data_by_client)
+    """
+    activation_class = AsyncHandlerActivation
+
+    @property
+    def handler(self):
+        return self._job
+
+    def ready(self):
+        if isinstance(self._job, ThisObject):
+            self._job = getattr(self.flow_class.instance, self._job.name)
+
+    def get_locked_activation(self, task):
+        """
+        Блокирует строку процесса (SELECT ... FOR UPDATE) до конца транзакции
+        и возвращает активацию задачи task, перечитанной из БД.
+        """
+        list(Process.objects.select_for_update().filter(pk=task.process_id).values_list('pk', flat=True))
+        task.refresh_from_db()
+        activation = self.activation_class()
+        activation.initialize(self, task)
+        return activation
+
+    def run_job(self, task):
+        """Выполняет обработчик задачи task под блокировкой процесса и активирует следующий шаг."""
+        activation = self.get_locked_activation(task)
+        if not activation.start.can_proceed():
+            # Задачу отменили или уже выполнили
+            return
+        activation.start()
+        self.handler(activation)
+        activation.done()
+
+    def job_failed(self, task, comments):
+        """Переводит задачу в ERROR после последней неудачной попытки, чтобы ошибка была видна в задаче."""
+        activation = self.get_locked_activation(task)
+        if not activation.start.can_proceed():
+            return
+        activation.start()
+        activation.error(comments=comments)
 
 
 class EndNode(TranslatedNodeMixin, nodes.End):
@@ -69,8 +188,24 @@ class ViewNode(TranslatedNodeMixin, nodes.View):
 
 
 class DownloadableViewNode(ViewNode):
+    """
+    Задача со скачиваемым документом по Заявке.
+    С prerender=True документ рендерится в кэш в фоне сразу после создания задачи
+    (см. michelin_bpm.main.signals.task_created), и при скачивании отдаётся готовый файл.
+    """
 
     download_view_class = None
+    render_document = None
+
+    def __init__(self, *args, **kwargs):
+        self.prerender = kwargs.pop('prerender', False)
+        super().__init__(*args, **kwargs)
+
+    def prerender_document(self, task):
+        """Рендерит документ по Заявке задачи в кэш (main.documents.render_cache)."""
+        if not self.render_document:
+            raise ImproperlyConfigured(_('You have to set "render_document" on DownloadableViewNode'))
+        self.render_document(task.flow_process).close()
 
     @property
     def download_view(self):
@@ -122,32 +257,19 @@ class DownloadableViewNode(ViewNode):
 class DownloadableXLSViewNode(DownloadableViewNode):
 
     download_view_class = ProposalExcelDocumentView
+    render_document = staticmethod(render_oiz_card)
 
 
 class DownloadableContractViewNode(DownloadableViewNode):
 
     download_view_class = ProposalPdfContractView
+    render_document = staticmethod(render_contract)
 
 
 class ApproveViewNode(LinkedNodeMixin, TranslatedNodeMixin, nodes.View):
-
-    def ready(self):
-        super().ready()
-        # Добавляем к viewflow.ThisObject flow_class,
-        # иначе в будущем при вызове viewflow.fields.get_task_ref(ThisObject) выйдет ошибка.
-        if 'show_corrections' in self._view_args:
-            value = self._view_args['show_corrections']
-            if isinstance(value, list):
-                for obj in value:
-                    if isinstance(obj['for_step'], ThisObject):
-                        obj['for_step'].flow_class = self.flow_class
-
-                    if 'made_on_step' in obj and isinstance(obj['made_on_step'], ThisObject):
-                        obj['made_on_step'].flow_class = self.flow_class
-
-        if 'can_create_corrections' in self._view_args:
-            value = self._view_args['can_create_corrections']
-            if isinstance(value, list):
-                for obj in value:
-                    if isinstance(obj['for_step'], ThisObject):
-                        obj['for_step'].flow_class = self.flow_class
+    """
+    Шаг согласования Заявки (ApproveView).
+    viewflow.ThisObject в show_corrections и can_create_corrections относятся к потоку этого шага,
+    ссылки на них берутся через michelin_bpm.main.refs.task_ref(obj, self.flow_class).
+    """
+    pass
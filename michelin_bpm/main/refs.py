@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Реестр строковых ссылок на шаги потоков (viewflow.fields.get_task_ref).
+
+Ссылки всех шагов считаются один раз при регистрации потока (см. michelin_bpm.main.apps.register),
+дальше ссылка по шагу находится поиском в словаре.
+
+>>> task_ref(this.approve_by_account_manager, ProposalConfirmationFlow)
+'main/flows.ProposalConfirmationFlow.approve_by_account_manager'
+"""
+import sys
+
+from viewflow import ThisObject
+from viewflow.fields import get_task_ref
+
+
+# (flow_class, имя шага) -> ссылка
+_refs = {}
+
+
+def register_flow(flow_class):
+    """Запоминает ссылки на все шаги потока."""
+    for node in flow_class._meta.nodes():
+        _refs[(flow_class, node.name)] = sys.intern(get_task_ref(node))
+
+
+def task_ref(flow_task, flow_class=None):
+    """
+    Возвращает ссылку на шаг.
+
+    :param flow_task: viewflow.Node или viewflow.ThisObject
+    :param flow_class: поток, к которому относится ThisObject (если у него нет атрибута flow_class)
+    :return: string
+    """
+    if isinstance(flow_task, ThisObject):
+        flow_class = getattr(flow_task, 'flow_class', None) or flow_class
+    else:
+        flow_class = flow_task.flow_class
+
+    key = (flow_class, flow_task.name)
+    ref = _refs.get(key)
+    if ref is None:
+        # Поток не зарегистрирован через michelin_bpm.main.apps.register
+        ref = _refs[key] = sys.intern(get_task_ref(flow_class._meta.node(flow_task.name)))
+    return ref
@@ -4,19 +4,23 @@ from django.conf import settings
 from django.template import loader
 from django.dispatch import receiver
 from django.db.models.signals import post_save
-from django.contrib.auth.models import Permission, Group
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
 from django.contrib.sites.models import Site
 from django.utils.translation import ugettext as _
 from django.urls import reverse
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
 
 from viewflow.signals import flow_finished
 from viewflow.models import Task
+from viewflow.activation import STATUS
 
 from michelin_bpm.main.views import UnblockClientView
-from michelin_bpm.main.utils import AgoraMailerClient
+from michelin_bpm.main.models import OutgoingMail, TaskEvent, ProposalProcess, BibServeProcess
 
 
+User = get_user_model()
+
 client_unblocked = dispatch.Signal(providing_args=['proposal'])
 
 
@@ -28,32 +32,108 @@ def client_unblocked_handler(sender, proposal, **kwargs):
         proposal.bibserveprocess.save()
 
 
+def get_permission_recipients(codename):
+    """
+    Возвращает email'ы активных пользователей, которым право с указанным codename выдано через группы.
+    Каждый email встречается один раз, даже если пользователь состоит в нескольких таких группах.
+    Не кэшируется: письма рассылает отдельный воркер, и изменения групп и прав должны сразу на нём сказываться.
+
+    :param codename: string, codename django.contrib.auth.models.Permission
+    :return: list of string
+    """
+    return list(
+        User.objects.filter(
+            is_active=True,
+            groups__permissions__codename=codename
+        ).exclude(
+            email=''
+        ).order_by().values_list('email', flat=True).distinct()
+    )
+
+
+# Шаги, о начале которых пользователям с правом на шаг рассылаются уведомления
+EMAIL_ON_TASK_STARTED = frozenset([
+    'approve_by_account_manager',
+    'approve_by_credit_manager',
+    'fix_mistakes_after_account_manager',
+    'approve_by_region_chief',
+    'get_comments_from_logist',
+    'approve_by_adv',
+    'create_user_in_inner_systems',
+    'add_j_code_by_adv',
+    'add_d_code_by_logist',
+    'set_credit_limit',
+    'approve_paper_docs',
+    'unblock_client',
+    'add_acs',
+])
+
+
 @receiver(post_save, sender=Task)
 def task_created(sender, instance, created, **kwargs):
-    EMAIL_ON_TASK_STARTED = [
-        'approve_by_account_manager',
-        'approve_by_credit_manager',
-        'fix_mistakes_after_account_manager',
-        'approve_by_region_chief',
-        'get_comments_from_logist',
-        'approve_by_adv',
-        'create_user_in_inner_systems',
-        'add_j_code_by_adv',
-        'add_d_code_by_logist',
-        'set_credit_limit',
-        'approve_paper_docs',
-        'unblock_client',
-        'add_acs',
-    ]
-    if created and instance.flow_task.name in EMAIL_ON_TASK_STARTED:
+    """
+    Записывает события о начале задачи в той же транзакции, что и сама задача.
+    Уведомления рассылаются и документы рендерятся уже после коммита воркером ./manage.py process_task_events,
+    см. process_task_event.
+    """
+    if not created:
+        return
+    if instance.flow_task.name in EMAIL_ON_TASK_STARTED:
+        TaskEvent.objects.create(task=instance, kind=TaskEvent.TASK_STARTED)
+    if getattr(instance.flow_task, 'prerender', False):
+        TaskEvent.objects.create(task=instance, kind=TaskEvent.PRERENDER_DOCUMENT)
+
+
+def process_task_event(event):
+    """Обрабатывает событие michelin_bpm.main.models.TaskEvent."""
+    if event.kind == TaskEvent.TASK_STARTED:
+        notify_task_started(event.task)
+    elif event.kind == TaskEvent.PRERENDER_DOCUMENT:
+        event.task.flow_task.prerender_document(event.task)
+    elif event.kind == TaskEvent.RUN_JOB:
+        event.task.flow_task.run_job(event.task)
+    elif event.kind == TaskEvent.START_BIBSERVE:
+        start_bibserve(event.task.process_id)
+
+
+def task_event_failed(event):
+    """Вызывается, когда событие не удалось обработать за TASK_EVENTS_MAX_ATTEMPTS попыток."""
+    if event.kind == TaskEvent.RUN_JOB:
+        event.task.flow_task.job_failed(event.task, event.last_error)
+
+
+def start_bibserve(proposal_id):
+    """
+    Запускает BibServeFlow для Заявки, если он ещё не запущен.
+    Заявка блокируется на время проверки, поэтому повторное событие не создаст второй процесс.
+    """
+    from michelin_bpm.main.flows import ProposalConfirmationFlow, BibServeFlow
+    from michelin_bpm.main.refs import task_ref
+
+    proposal = ProposalProcess.objects.select_for_update().get(pk=proposal_id)
+    if BibServeProcess.objects.filter(proposal=proposal).exists():
+        return
+    BibServeFlow.start.run(proposal)
+
+    # Если клиента разблокировали раньше, чем отработал воркер, client_unblocked_handler процесс не застал
+    unblocked = proposal.task_set.filter(
+        flow_task=task_ref(ProposalConfirmationFlow.unblock_client), status=STATUS.DONE
+    ).exists()
+    if unblocked:
+        BibServeProcess.objects.filter(proposal=proposal).update(is_allowed_to_activate=True)
+
+
+def notify_task_started(task):
+    """Рассылает уведомление о новой задаче всем, у кого есть право на её выполнение."""
+    if task.flow_task.name in EMAIL_ON_TASK_STARTED:
         perm_name = 'can_{}_{}'.format(
-            instance.flow_task.name,
-            instance.flow_process.flow_class.process_class._meta.model_name,
+            task.flow_task.name,
+            task.flow_task.flow_class.process_class._meta.model_name,
         )
-        perm = Permission.objects.filter(codename=perm_name).first()
-        if perm:
+        recipients = get_permission_recipients(perm_name)
+        if recipients:
             subject = _('New task: ')
-            subject += instance.flow_task.task_title
+            subject += task.flow_task.task_title
 
             if not settings.DEBUG:
                 current_site = Site.objects.get_current()
@@ -62,33 +142,32 @@ def task_created(sender, instance, created, **kwargs):
             else:
                 domain = 'localhost:8000'
                 protocol = 'http'
-            task_link = instance.flow_task.get_task_url(
-                task=instance,
+            task_link = task.flow_task.get_task_url(
+                task=task,
                 namespace='viewflow:main:proposalconfirmation'
             )
             task_link += '?back=%2Fworkflow%2F'
             context = {
-                'task_title': instance.flow_task.task_title,
-                'task_created': instance.created,
-                'proposal_name': instance.flow_process.summary(),
+                'task_title': task.flow_task.task_title,
+                'task_created': task.created,
+                'proposal_name': task.flow_process.summary(),
                 'task_link': task_link,
                 'domain': domain,
                 'protocol': protocol,
             }
             from_email = settings.DEFAULT_FROM_EMAIL
 
-            for group in perm.group_set.all():
-                for user in group.user_set.filter(is_active=True):
-                    if settings.DEBUG:
-                        body = loader.render_to_string(
-                            'main/proposalconfirmation/email/new_task_created.html',
-                            context
-                        )
-                        email_message = EmailMultiAlternatives(subject, body, from_email, [user.email])
-                        email_message.send()
-                    else:
-                        mailer = AgoraMailerClient()
-                        mailer.send('michelin_bpm_new_task_created', user.email, from_email, context)
+            if settings.DEBUG:
+                body = loader.render_to_string(
+                    'main/proposalconfirmation/email/new_task_created.html',
+                    context
+                )
+                get_connection().send_messages([
+                    EmailMultiAlternatives(subject, body, from_email, [email])
+                    for email in recipients
+                ])
+            else:
+                OutgoingMail.enqueue('michelin_bpm_new_task_created', recipients, from_email, context)
 
 
 @receiver(flow_finished)
@@ -137,8 +216,7 @@ def new_account_created(sender, process, task, **kwargs):
                 email_message = EmailMultiAlternatives(subject, body, from_email, [send_to])
                 email_message.send()
             else:
-                mailer = AgoraMailerClient()
-                mailer.send('michelin_bpm_new_account_created', send_to, from_email, context)
+                OutgoingMail.enqueue('michelin_bpm_new_account_created', [send_to], from_email, context)
 
 
 @receiver(flow_finished)
@@ -181,5 +259,6 @@ def new_bibserve_account_created(sender, process, task, **kwargs):
             email_message = EmailMultiAlternatives(subject, body, from_email, [process.proposal.client.email])
             email_message.send()
         else:
-            mailer = AgoraMailerClient()
-            mailer.send('michelin_bpm_new_bibserve_account_created', process.proposal.client.email, from_email, context)
+            OutgoingMail.enqueue(
+                'michelin_bpm_new_bibserve_account_created', [process.proposal.client.email], from_email, context
+            )
@@ -2,7 +2,8 @@
 from __future__ import unicode_literals
 
 from django import template
-from django.conf import settings
+
+from michelin_bpm.main.utils import get_user_roles
 
 
 register = template.Library()
@@ -39,12 +40,12 @@ def get_prev_field_by_index(obj, key):
 
 @register.assignment_tag
 def check_is_client(user):
-    return user.groups.filter(pk=settings.CLIENTS_GROUP_ID).exists()
+    return get_user_roles(user).is_client
 
 
 @register.assignment_tag
 def check_is_acs(user):
-    return user.groups.filter(pk=settings.ACS_GROUP_ID).exists()
+    return get_user_roles(user).is_acs
 
 
 @register.assignment_tag
@@ -1,3 +1,165 @@
-from django.test import TestCase
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from michelin_bpm.main.models import OutgoingMail, ContractCounter
+
+
+class StubMailerHandler(BaseHTTPRequestHandler):
+    """Мейлер-заглушка: отвечает OK на всё, кроме писем на FAIL_RECIPIENT."""
+
+    FAIL_RECIPIENT = 'fail@example.com'
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        bundle = {key: values[0] for key, values in parse_qs(self.rfile.read(length).decode()).items()}
+        self.server.requests.append(bundle)
+
+        body = b'ERROR' if bundle['recipient'] == self.FAIL_RECIPIENT else b'OK'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubMailerMixin:
+
+    def setUp(self):
+        super().setUp()
+        self.mailer = HTTPServer(('127.0.0.1', 0), StubMailerHandler)
+        self.mailer.requests = []
+        thread = threading.Thread(target=self.mailer.serve_forever, daemon=True)
+        thread.start()
+
+        settings_override = override_settings(
+            DB_MAILER_ROOT_URL='http://127.0.0.1:{}'.format(self.mailer.server_port),
+            DB_MAILER_TIMEOUT=5,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(self.mailer.server_close)
+        self.addCleanup(self.mailer.shutdown)
+
+
+class OutgoingMailEnqueueTest(TransactionTestCase):
+
+    def test_enqueued_on_commit(self):
+        with transaction.atomic():
+            OutgoingMail.enqueue('slug', ['a@example.com', 'b@example.com'], 'from@example.com', {'x': 1})
+            self.assertEqual(OutgoingMail.objects.count(), 0)
+        self.assertEqual(OutgoingMail.objects.count(), 2)
+
+    def test_not_enqueued_on_rollback(self):
+        with transaction.atomic():
+            OutgoingMail.enqueue('slug', ['a@example.com'], 'from@example.com', {'x': 1})
+            transaction.set_rollback(True)
+        self.assertEqual(OutgoingMail.objects.count(), 0)
+
+
+@override_settings(MAIL_QUEUE_MAX_ATTEMPTS=2, MAIL_QUEUE_RETRY_DELAY=60)
+class SendQueuedMailTest(StubMailerMixin, TestCase):
+
+    def create_mail(self, recipient):
+        return OutgoingMail.objects.create(
+            slug='new-task', recipient=recipient, from_email='from@example.com', data='{"x": 1}'
+        )
+
+    def test_sends_queued_mail(self):
+        mail = self.create_mail('ok@example.com')
+
+        call_command('send_queued_mail')
+
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutgoingMail.SENT)
+        self.assertEqual(mail.attempts, 1)
+        self.assertIsNotNone(mail.sent)
+        self.assertEqual(len(self.mailer.requests), 1)
+        self.assertEqual(self.mailer.requests[0]['recipient'], 'ok@example.com')
+        self.assertEqual(self.mailer.requests[0]['slug'], 'new-task')
+        self.assertEqual(self.mailer.requests[0]['data'], '{"x": 1}')
+
+    def test_failed_mail_is_retried_with_backoff(self):
+        mail = self.create_mail(StubMailerHandler.FAIL_RECIPIENT)
+
+        call_command('send_queued_mail')
+
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutgoingMail.NEW)
+        self.assertEqual(mail.attempts, 1)
+        self.assertGreater(mail.next_attempt_at, timezone.now())
+        self.assertIn('Email send failed', mail.last_error)
+
+        # Задержка ещё не прошла, письмо не отправляется повторно
+        call_command('send_queued_mail')
+        self.assertEqual(len(self.mailer.requests), 1)
+
+        OutgoingMail.objects.filter(pk=mail.pk).update(next_attempt_at=timezone.now())
+        call_command('send_queued_mail')
+
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutgoingMail.FAILED)
+        self.assertEqual(mail.attempts, 2)
+        self.assertEqual(len(self.mailer.requests), 2)
+
+    def test_stale_claim_is_picked_up_again(self):
+        mail = self.create_mail('ok@example.com')
+        # Письмо забрал воркер, который упал, не записав результат
+        OutgoingMail.objects.filter(pk=mail.pk).update(
+            status=OutgoingMail.SENDING, next_attempt_at=timezone.now()
+        )
+
+        call_command('send_queued_mail')
+
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutgoingMail.SENT)
+
+
+class ContractCounterTest(TransactionTestCase):
+
+    def allocate_concurrently(self, year, workers, per_worker):
+        """Выдаёт номера из нескольких потоков одновременно, у каждого потока своё соединение с БД."""
+        barrier = threading.Barrier(workers)
+        numbers = []
+        errors = []
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(per_worker):
+                    number = ContractCounter.allocate(year)
+                    with lock:
+                        numbers.append(number)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        return numbers
+
+    def test_concurrent_allocation_gives_unique_numbers(self):
+        # Счётчик года ещё не существует: все потоки одновременно пытаются его создать
+        numbers = self.allocate_concurrently(2030, workers=8, per_worker=10)
+
+        self.assertEqual(sorted(numbers), list(range(1, 81)))
+        self.assertEqual(ContractCounter.objects.get(year=2030).last_number, 80)
+
+    def test_years_are_counted_separately(self):
+        self.assertEqual(ContractCounter.allocate(2030), 1)
+        self.assertEqual(ContractCounter.allocate(2031), 1)
+        self.assertEqual(ContractCounter.allocate(2030), 2)
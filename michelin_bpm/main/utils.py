@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
+import io
 import json
+import pickle
+import operator
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import chain
+
 import requests
 from urllib.parse import urljoin
 import xlrd
@@ -30,15 +38,109 @@ class LocalizeEncoder(LazyEncoder):
         return super(LocalizeEncoder, self).default(obj)
 
 
+class LRUCache:
+    """
+    Ограниченный по кол-ву элементов LRU-кэш, общий для всех запросов в рамках процесса.
+    Считает попадания и промахи.
+
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache.get_or_set('key', lambda: 'value')
+    'value'
+    """
+
+    def __init__(self, maxsize: int=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, default):
+        """Возвращает значение по ключу. Если его нет, то вычисляет его через default() и запоминает."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+
+        value = default()
+
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class UserRoles:
+    """
+    Роли пользователя по его группам. id групп загружаются одним запросом при первом обращении.
+    Используйте get_user_roles, чтобы в рамках запроса роли вычислялись один раз.
+    Между запросами роли не кэшируются: изменение групп должно сразу влиять на доступ во всех процессах.
+
+    >>> get_user_roles(request.user).is_client
+    False
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._group_ids = None
+
+    @property
+    def group_ids(self):
+        if self._group_ids is None:
+            if not self.user.is_authenticated:
+                self._group_ids = frozenset()
+            else:
+                self._group_ids = frozenset(self.user.groups.values_list('pk', flat=True))
+        return self._group_ids
+
+    def in_group(self, group_id):
+        return int(group_id) in self.group_ids
+
+    @property
+    def is_client(self):
+        return self.in_group(settings.CLIENTS_GROUP_ID)
+
+    @property
+    def is_acs(self):
+        return self.in_group(settings.ACS_GROUP_ID)
+
+
+def get_user_roles(user):
+    """Возвращает UserRoles пользователя, сохранённый на самом объекте пользователя (т.е. на request.user)."""
+    roles = getattr(user, '_michelin_user_roles', None)
+    if roles is None:
+        roles = UserRoles(user)
+        user._michelin_user_roles = roles
+    return roles
+
+
+class MailerError(Exception):
+    pass
+
+
 class AgoraMailerClient:
     """
     Encapsulates a routine interaction with Mailer API.
 
     >>> mailer = AgoraMailerClient('api_key', 'https://mailer.ru')
     >>> response = mailer.send('marfa-password-reset-complete-en', 'admin@yandex.ru', {'context': '-'})
+
+    Чтобы переиспользовать соединения при отправке нескольких писем, можно передать requests.Session.
     """
 
-    def __init__(self, api_key: str='', root_url: str=''):
+    def __init__(self, api_key: str='', root_url: str='', session: requests.Session=None, timeout: float=None):
         self.api_key = api_key or getattr(settings, 'DB_MAILER_API_KEY', None)
         assert self.api_key, 'Where is my API Key?'
 
@@ -46,36 +148,155 @@ class AgoraMailerClient:
         assert self.api_key, 'Where is my root url?'
 
         self.send_api_url = urljoin(self.root_url, '/dbmail/api/')
+        self.session = session or requests
+        self.timeout = timeout or getattr(settings, 'DB_MAILER_TIMEOUT', 10)
 
     def send(self, slug: str, recipient: str, from_email: str, context: dict):
+        return self.send_encoded(slug, recipient, from_email, self.encode_context(context))
+
+    @staticmethod
+    def encode_context(context: dict):
+        return json.dumps(context, cls=LocalizeEncoder)
+
+    def send_encoded(self, slug: str, recipient: str, from_email: str, data: str):
+        """То же, что и send, но контекст письма уже сериализован через encode_context."""
         bundle = {
-            'data': json.dumps(context, cls=LocalizeEncoder),
+            'data': data,
             'api_key': self.api_key,
             'recipient': recipient,
             'from_email': from_email,
             'slug': slug
         }
-        response = requests.post(self.send_api_url, bundle)
-        assert response.text == 'OK', 'Email send failed'
+        response = self.session.post(self.send_api_url, bundle, timeout=self.timeout)
+        if response.text != 'OK':
+            raise MailerError('Email send failed: {} {}'.format(response.status_code, response.text[:255]))
         return response
 
 
-def render_excel_template(template_path, context, filename):
-    """Заполняет excel-шаблон данными из контекста и сохраняет результат в файл."""
-    def copy2(wb):
-        w = XLWTWriter()
-        process(XLRDReader(wb, 'unknown.xls'), w)
-        return w.output[0][1], w.style_list
+class ExcelTemplate:
+    """
+    Excel-шаблон, разобранный один раз.
+    xlrd-книга нужна для стилей ячеек, а копия для записи (xlwt) хранится в виде pickle-снимка,
+    из которого для каждого рендера быстро восстанавливается новая книга.
+    """
+
+    def __init__(self, template_path, sheet_name):
+        self.sheet_name = sheet_name
+        rdbook = xlrd.open_workbook(template_path, formatting_info=True)
+        self.rdsheet = rdbook.sheet_by_name(sheet_name)
+
+        writer = XLWTWriter()
+        process(XLRDReader(rdbook, 'unknown.xls'), writer)
+        self._snapshot = pickle.dumps((writer.output[0][1], writer.style_list), pickle.HIGHEST_PROTOCOL)
+
+    def new_book(self):
+        """Возвращает новую книгу для записи и список её стилей."""
+        return pickle.loads(self._snapshot)
 
-    rdbook = xlrd.open_workbook(template_path, formatting_info=True)
-    sheet_name = 'Main list'
-    rdsheet = rdbook.sheet_by_name(sheet_name)
-    wtbook, style_list = copy2(rdbook)
-    wtsheet = wtbook.get_sheet(sheet_name)
+
+@lru_cache(maxsize=None)
+def get_excel_template(template_path, sheet_name='Main list'):
+    """Возвращает ExcelTemplate, загруженный один раз на процесс."""
+    return ExcelTemplate(template_path, sheet_name)
+
+
+def render_excel_template(template_path, context):
+    """Заполняет excel-шаблон данными из контекста. Возвращает io.BytesIO с готовым файлом."""
+    template = get_excel_template(template_path)
+    wtbook, style_list = template.new_book()
+    wtsheet = wtbook.get_sheet(template.sheet_name)
     for pos, value in context.items():
         rowx, colx = pos
-        xf_index = rdsheet.cell_xf_index(rowx, colx)
+        xf_index = template.rdsheet.cell_xf_index(rowx, colx)
         if not value:
             value = ''
         wtsheet.write(rowx, colx, str(value), style_list[xf_index])
-    wtbook.save(filename)
+
+    output = io.BytesIO()
+    wtbook.save(output)
+    output.seek(0)
+    return output
+
+
+class ExcelLayout:
+    """
+    Декларативная разметка документа по excel-шаблону.
+
+    cells - {(row, col): источник значения} для полей объекта,
+    repeated_cells - то же для повторяющегося блока (например, Доставочных адресов), строки считаются от начала блока,
+    repeat_offsets - строки, с которых начинаются повторяющиеся блоки.
+    Источник значения - имя атрибута или функция от объекта.
+
+    Разметка компилируется один раз: стили ячеек берутся из шаблона заранее,
+    и рендер сводится к записи готового списка значений.
+
+    >>> layout = ExcelLayout('card.xls', {(1, 0): 'company_name'}, {(0, 5): 'delivery_city'}, [43, 108])
+    >>> excel = layout.render(proposal, proposal.deliveryaddress_set.all())
+    """
+
+    def __init__(self, template_path, cells, repeated_cells=None, repeat_offsets=(), sheet_name='Main list'):
+        self.template_path = template_path
+        self.sheet_name = sheet_name
+        self.cells = cells
+        self.repeated_cells = repeated_cells or {}
+        self.repeat_offsets = list(repeat_offsets)
+        self._compiled = None
+
+    @staticmethod
+    def _get_getter(source):
+        return operator.attrgetter(source) if isinstance(source, str) else source
+
+    def compile(self):
+        """Возвращает (шаблон, ячейки объекта, ячейки каждого блока), ячейка - (row, col, xf_index, getter)."""
+        if self._compiled is None:
+            template = get_excel_template(self.template_path, self.sheet_name)
+            xf_index = template.rdsheet.cell_xf_index
+            cells = [
+                (row, col, xf_index(row, col), self._get_getter(source))
+                for (row, col), source in self.cells.items()
+            ]
+            blocks = [
+                [
+                    (offset + row, col, xf_index(offset + row, col), self._get_getter(source))
+                    for (row, col), source in self.repeated_cells.items()
+                ]
+                for offset in self.repeat_offsets
+            ]
+            self._compiled = (template, cells, blocks)
+        return self._compiled
+
+    def get_values(self, obj, items=()):
+        """
+        Значения ячеек в порядке скомпилированной разметки, приведённые к строкам.
+        items - объекты для повторяющихся блоков, лишние (сверх кол-ва блоков) отбрасываются.
+        """
+        template, cells, blocks = self.compile()
+        values = [getter(obj) for row, col, xf_index, getter in cells]
+        for block, item in zip(blocks, items):
+            values.extend(getter(item) for row, col, xf_index, getter in block)
+        return [str(value) if value else '' for value in values]
+
+    def get_context(self, obj, items=()):
+        """Значения ячеек в виде {(row, col): value}, как для render_excel_template."""
+        template, cells, blocks = self.compile()
+        return {
+            (row, col): value
+            for (row, col, xf_index, getter), value in zip(chain(cells, *blocks), self.get_values(obj, items))
+        }
+
+    def render_values(self, values):
+        """Рендерит документ по списку значений из get_values. Возвращает io.BytesIO."""
+        template, cells, blocks = self.compile()
+        wtbook, style_list = template.new_book()
+        write = wtbook.get_sheet(self.sheet_name).write
+        for (row, col, xf_index, getter), value in zip(chain(cells, *blocks), values):
+            write(row, col, value, style_list[xf_index])
+
+        output = io.BytesIO()
+        wtbook.save(output)
+        output.seek(0)
+        return output
+
+    def render(self, obj, items=()):
+        """Рендерит документ по объекту и объектам повторяющихся блоков. Возвращает io.BytesIO."""
+        return self.render_values(self.get_values(obj, items))
@@ -1,42 +1,45 @@
 # -*- coding: utf-8 -*-
 import datetime
-import os
-import locale
-import calendar
 import logging
-import json
-from templated_docs import fill_template
+from collections import OrderedDict
 
 from django.forms import inlineformset_factory
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseBadRequest
-from django.conf import settings
+from django.http import (
+    HttpResponseRedirect, HttpResponseBadRequest, FileResponse, StreamingHttpResponse
+)
 from django.core.exceptions import PermissionDenied
 from django.utils.decorators import method_decorator
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.views import PasswordResetConfirmView
 from django.utils.translation import ugettext_lazy as _
 from django.utils.html import mark_safe
 from django.urls import reverse
 from django.views.generic.edit import UpdateView
 from django.views import View
-from django.utils.translation import ugettext_lazy as l_
 from django.template.response import TemplateResponse
+from django.db.models import Count
 
 import reversion
-from reversion.models import Version
 
 from viewflow.decorators import flow_view
 from viewflow.flow.views.task import UpdateProcessView
 from viewflow.flow.views import CreateProcessView
 from viewflow.flow.views.detail import DetailProcessView
-from viewflow.fields import get_task_ref
 from viewflow.frontend.views import ProcessListView
+from viewflow.models import Task
 
-from michelin_bpm.main.models import ProposalProcess, Correction, BibServeProcess, DeliveryAddress
+from michelin_bpm.main.models import (
+    ProposalProcess, Correction, BibServeProcess, DeliveryAddress, ContractCounter, TaskEvent
+)
 from michelin_bpm.main.forms import (
-    ClientSetPasswordForm, ShowProposalForm, DeliveryAddressForm, all_fields, DeliveryAddressReadonlyForm
+    ClientSetPasswordForm, ShowProposalForm, DeliveryAddressForm, all_fields, DeliveryAddressReadonlyForm,
+    OIZCardsExportForm
+)
+from michelin_bpm.main.utils import get_user_roles
+from michelin_bpm.main.refs import task_ref
+from michelin_bpm.main.documents import (
+    render_contract, render_oiz_card, get_inner_systems_proposals, iter_oiz_cards_zip
 )
-from michelin_bpm.main.utils import render_excel_template
 
 
 logger = logging.getLogger(__name__)
@@ -103,14 +106,7 @@ class VersionViewMixin:
     """
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
-
-        current_version = Version.objects.get_for_object(
-            kwargs['instance']
-        ).order_by(
-            '-revision__date_created'
-        ).first()
-
-        kwargs.update({'current_version': current_version})
+        kwargs.update({'current_version': kwargs['instance'].get_last_version_id()})
         return kwargs
 
 
@@ -155,47 +151,11 @@ class ProposalPdfContractView(View):
     Add templated_docs to INSTALLED_APPS
     """
     def get(self, request):
-        # if not proposal_id:
-        #     return HttpResponseBadRequest()
-
-        # import ipdb; ipdb.set_trace()
-
-        # p = ProposalProcess.objects.get(pk=proposal_id) if proposal_id else ProposalProcess.objects.first()  # for testing
         p = self.activation.process
-        da = p.deliveryaddress_set.first()
-
-        try:
-            locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
-        except locale.Error as err:
-            logger.error('Can\'t set russian locale (get month name)!')
-        contract_month_name = calendar.month_name[p.contract_date.month] if p.contract_date else ''
-
-        def get_full_address(list_of_parts):
-            return ', '.join(filter(bool, list_of_parts))
-
-        context = vars(p)
-        context = {k: (v if v else '') for k, v in context.items()}
-        more = {
-            'p': p,
-            'pcd': p.contract_date.day if p.contract_date else '',
-            'pcm': contract_month_name,
-            'pcy': p.contract_date.year if p.contract_date else '',
-            'full_address': get_full_address([p.zip_code, p.country, p.region, p.city, p.street, p.building, p.block]),
-            'jur_full_address': get_full_address([p.jur_zip_code, p.jur_country, p.jur_region, p.jur_city,
-                                                  p.jur_street, p.jur_building, p.jur_block]),
-            'delivery_full_address': get_full_address([da.delivery_zip_code, da.delivery_country, da.delivery_region,
-                                                       da.delivery_city, da.delivery_street, da.delivery_building,
-                                                       da.delivery_block]) if da else '',
-        }
-        context = {**context, **more}
-        filename = fill_template('main/contract.odt', context, output_format='pdf')
-
-        with open(filename, 'rb') as excel:
-            data = excel.read()
-
-            response = HttpResponse(data, content_type='application/pdf')
-            response['Content-Disposition'] = 'attachment; filename=contract.pdf'
-            return response
+
+        response = FileResponse(render_contract(p), content_type='application/pdf')
+        response['Content-Disposition'] = 'attachment; filename=contract.pdf'
+        return response
 
     @method_decorator(flow_view)
     def dispatch(self, request, *args, **kwargs):
@@ -209,6 +169,7 @@ class ProposalPdfContractView(View):
 
 class ProposalExcelDocumentView(View):
     """Заявка в формате excel."""
+
     def get(self, request):
         # TODO MBPM-3:
         # Добавить тут валидацию на существующую Заявку и на то, что задача по ней пренадлежит этому пользователю.
@@ -217,107 +178,11 @@ class ProposalExcelDocumentView(View):
         # p = ProposalProcess.objects.get(pk=proposal_id) if proposal_id else ProposalProcess.objects.first()  # for testing
         p = self.activation.process
 
-        template_path = '{}/static/main/proposal-info.xls'.format(os.path.abspath(os.path.dirname(__file__)))
-        context = {
-            (1, 0): p.company_name,
-            (1, 8): p.date.strftime('%d/%m/%Y'),
-            (3, 0): p.operation_type_name,
-            (10, 1): p.jur_form,
-            (10, 5): p.client_name,
-
-            (17, 4): p.jur_zip_code,
-            (17, 7): p.jur_country,
-            (18, 3): p.jur_region,
-            (18, 7): p.jur_city,
-            (19, 1): p.jur_street,
-            (19, 5): p.jur_building,
-            (19, 7): p.jur_block,
-            (20, 1): p.inn,
-            (20, 3): p.kpp,
-            (20, 5): p.okpo,
-            (20, 7): p.ogrn,
-
-            (23, 2): p.bank_details,
-            (24, 1): p.bik,
-            (24, 3): p.corr_account_number,
-            (25, 2): p.account_number,
-
-            (27, 3): p.contract_number,
-            (27, 6): p.contract_date.strftime('%d/%m/%Y') if p.contract_date else '',
-
-            (29, 4): p.zip_code,
-            (29, 7): p.country,
-            (30, 3): p.region,
-            (30, 7): p.city,
-            (31, 1): p.street,
-            (31, 5): p.building,
-            (31, 7): p.block,
-
-            (32, 3): p.dir_name,
-            (32, 7): p.dir_tel,
-            (33, 1): p.dir_email,
-            (33, 7): p.dir_fax,
-
-            (34, 2): p.buh_name,
-            (34, 7): p.buh_tel,
-            (35, 1): p.buh_email,
-            (35, 7): p.buh_fax,
-
-            (36, 2): p.contact_name,
-            (36, 7): p.contact_tel,
-            (37, 1): p.contact_email,
-            (37, 7): p.contact_fax,
-
-            (39, 8): l_('Да') if p.is_needs_bibserve_account else l_('Нет'),
-            (40, 2): p.bibserve_login,
-            (41, 1): p.bibserve_email,
-            (41, 7): p.bibserve_tel,
-
-            (65, 0): p.company_name,
-        }
-
-        offset = [43, 108, 132, 156, 180]
-        for i, da in enumerate(p.deliveryaddress_set.order_by('pk').all()[:5]):
-            context.update({
-                (offset[i], 5): da.delivery_client_name,
-                (offset[i] + 1, 4): da.delivery_zip_code,
-                (offset[i] + 1, 7): da.delivery_country,
-                (offset[i] + 2, 3): da.delivery_region,
-                (offset[i] + 2, 7): da.delivery_city,
-                (offset[i] + 3, 1): da.delivery_street,
-                (offset[i] + 3, 5): da.delivery_building,
-                (offset[i] + 3, 7): da.delivery_block,
-                (offset[i] + 4, 3): da.delivery_contact_name,
-                (offset[i] + 4, 7): da.delivery_tel,
-                (offset[i] + 5, 7): da.delivery_fax,
-                (offset[i] + 6, 5): da.delivery_email,
-
-                (offset[i] + 10, 4): da.warehouse_working_hours_from,
-                (offset[i] + 10, 6): da.warehouse_working_hours_to,
-                (offset[i] + 11, 4): da.warehouse_break_from,
-                (offset[i] + 11, 6): da.warehouse_break_to,
-                (offset[i] + 13, 2): da.warehouse_comment,
-                (offset[i] + 16, 2): da.warehouse_consignee_code,
-                (offset[i] + 17, 2): da.warehouse_station_code,
-                (offset[i] + 15, 7): da.warehouse_tc,
-                (offset[i] + 16, 7): da.warehouse_pl,
-                (offset[i] + 17, 7): da.warehouse_gc,
-                (offset[i] + 18, 7): da.warehouse_ag,
-                (offset[i] + 19, 7): da.warehouse_2r,
-            })
-
-        path = '{}proposal-info/'.format(settings.MEDIA_ROOT)
-        os.makedirs(path, exist_ok=True)
-        path = '{}proposal-{}.xls'.format(path, p.pk)
-
-        render_excel_template(template_path, context, path)
-
-        with open(path, 'rb') as excel:
-            data = excel.read()
-
-            response = HttpResponse(data, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename=proposal-info.xls'
-            return response
+        response = FileResponse(
+            render_oiz_card(p), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+        response['Content-Disposition'] = 'attachment; filename=proposal-info.xls'
+        return response
 
     @method_decorator(flow_view)
     def dispatch(self, request, *args, **kwargs):
@@ -329,6 +194,31 @@ class ProposalExcelDocumentView(View):
         return super().dispatch(request, *args, **kwargs)
 
 
+@method_decorator(login_required, name='dispatch')
+@method_decorator(
+    permission_required('main.can_create_user_in_inner_systems_proposalprocess', raise_exception=True),
+    name='dispatch'
+)
+class OIZCardsExportView(View):
+    """
+    ZIP-архив с Карточками ОИЗ по всем Заявкам, дошедшим до create_user_in_inner_systems за период.
+    /export/oiz-cards/?date_from=2018-01-01&date_to=2018-01-31
+    """
+    def get(self, request):
+        form = OIZCardsExportForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text())
+
+        date_from, date_to = form.cleaned_data['date_from'], form.cleaned_data['date_to']
+        proposals = get_inner_systems_proposals(date_from, date_to)
+
+        response = StreamingHttpResponse(iter_oiz_cards_zip(proposals), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename=proposal-info-{:%Y%m%d}-{:%Y%m%d}.zip'.format(
+            date_from, date_to
+        )
+        return response
+
+
 class CreateProposalProcessView(ActionTitleMixin, CreateProcessView):
 
     linked_node = None
@@ -344,6 +234,33 @@ class ShowCorrectionsMixin:
 
     linked_node = None
 
+    _fields_corrections = None
+    # Сколько раз за время жизни view были посчитаны fields_corrections, для отладки
+    fields_corrections_builds = 0
+
+    def get_corrections_object(self):
+        """Заявка, Корректировки которой показываются. Загружается один раз за запрос."""
+        if getattr(self, 'object', None) is None:
+            self.object = self.get_object()
+        return self.object
+
+    def get_cached_fields_corrections(self):
+        """
+        Возвращает результат get_fields_corrections, посчитанный один раз в рамках текущего запроса.
+        Кэш сбрасывается через invalidate_fields_corrections.
+        """
+        if self._fields_corrections is None:
+            self._fields_corrections = self.get_fields_corrections(self.get_corrections_object())
+            self.fields_corrections_builds += 1
+            logger.debug(
+                'fields_corrections built %s time(s) by %s',
+                self.fields_corrections_builds, self.__class__.__name__
+            )
+        return self._fields_corrections
+
+    def invalidate_fields_corrections(self):
+        self._fields_corrections = None
+
     def get_fields_corrections(self, instance):
         """
         Возвращает dict с ключами с именем полей и значениями в виде Корректировок и историй изменений заявки.
@@ -353,105 +270,90 @@ class ShowCorrectionsMixin:
         # {'for_step': '', 'made_on_step': ''}
         # добавляем имя своего шага, чтобы видеть корректировки, созданные для этого шага
         for_steps.append(
-            {'for_step': get_task_ref(self.linked_node)}
+            {'for_step': task_ref(self.linked_node)}
         )
         # добавляем возможность видеть корректировки для других шагов, если это настроенно в ноде
         for corr_setting in self.show_corrections:
             for_steps.append({
-                'for_step': get_task_ref(corr_setting['for_step']),
-                'made_on_step': get_task_ref(corr_setting['made_on_step']) if ('made_on_step' in corr_setting) else None
+                'for_step': task_ref(corr_setting['for_step'], self.linked_node.flow_class),
+                'made_on_step': (
+                    task_ref(corr_setting['made_on_step'], self.linked_node.flow_class)
+                    if ('made_on_step' in corr_setting) else None
+                )
             })
-        corrections_qs = instance.get_corrections_all(for_steps)
+        corrections_qs = instance.get_corrections_all(for_steps).select_related(
+            'task', 'owner', 'reviewed_version', 'fixed_in_version'
+        )
 
         # Поля, которые видит пользователь в рамках этого view
         fields = self.fields
         if not fields:
-            fields = self.form_class.base_fields.keys()
             fields = [name for (name, field) in self.form_class.base_fields.items()]
+        fields_set = set(fields)
 
+        # Корректировки для полей, которые попали в изменения по корректировке для всей заявки
         fields_corrections = {}
+        # Корректировки, созданные непосредственно для полей
+        own_fields_corrections = {}
 
-        # Добавляем non_field поле
+        # Один проход по Корректировкам: раскладываем каждую по полям, к которым она относится
         for correction in corrections_qs:
-            if '__all__' in correction.data:
-                non_field_corr = {
-                    'msg': correction.data['__all__'],
-                    'from_step': str(correction.task.flow_task),
-                    'from_step_obj': correction.task.flow_task,
-                    'owner': str(correction.owner),
-                    'created': correction.created,
-                    'is_active': correction.is_active,
-                    'changed_fieldschanged_fields': None,
-                }
-                if '__all__' in fields_corrections:
-                    fields_corrections['__all__'].append(non_field_corr)
-                else:
-                    fields_corrections['__all__'] = [non_field_corr]
+            correction_fields = [name for name in correction.data if name in fields_set]
+            is_non_field = '__all__' in correction.data
+            if not correction_fields and not is_non_field:
+                continue
+
+            from_step_obj = correction.task.flow_task
+            base_corr = {
+                'from_step': str(from_step_obj),
+                'from_step_obj': from_step_obj,
+                'owner': str(correction.owner),
+                'created': correction.created,
+                'is_active': correction.is_active,
+            }
+
+            diff = {}
+            if correction.fixed_in_version:
+                diff = ProposalProcess.get_diff_data(
+                    ProposalProcess.get_version_data(correction.fixed_in_version),
+                    ProposalProcess.get_version_data(correction.reviewed_version),
+                    fields if is_non_field else correction_fields
+                )
+
+            if is_non_field:
+                non_field_corr = dict(base_corr, msg=correction.data['__all__'], changed_fields=None)
+                fields_corrections.setdefault('__all__', []).append(non_field_corr)
 
                 if correction.fixed_in_version:
-                    base_instace = json.loads(correction.fixed_in_version.serialized_data)[0]['fields']
-                    diff = ProposalProcess.get_diff_fields(
-                        base_instace,
-                        correction.reviewed_version,
-                        fields
-                    )
                     non_field_corr['changed_fields'] = diff
                     for (changed_field_name, changed_field_old_value) in diff.items():
-                        field_corr = {
-                            'msg': correction.data['__all__'],
-                            'from_step': str(correction.task.flow_task),
-                            'from_step_obj': correction.task.flow_task,
-                            'owner': str(correction.owner),
-                            'created': correction.created,
-                            'is_active': correction.is_active,
-                            'version_value': None
-                        }
-                        if correction.fixed_in_version:
-                            field_corr['version_value'] = changed_field_old_value['old_value']
-                        if changed_field_name in fields_corrections:
-                            fields_corrections[changed_field_name].append(field_corr)
-                        else:
-                            fields_corrections[changed_field_name] = [field_corr]
-
-        for field_name in fields:
-            for correction in corrections_qs:
-                if field_name in correction.data:
-                    field_corr = {
-                        'msg': correction.data[field_name],
-                        'from_step': str(correction.task.flow_task),
-                        'from_step_obj': correction.task.flow_task,
-                        'owner': str(correction.owner),
-                        'created': correction.created,
-                        'is_active': correction.is_active,
-                        'version_value': None,
-                    }
-                    if correction.fixed_in_version:
-                        base_instace = json.loads(correction.fixed_in_version.serialized_data)[0]['fields']
-
-                        diff = ProposalProcess.get_diff_fields(
-                            base_instace,
-                            correction.reviewed_version,
-                            [field_name]
-                        )
-                        if diff:
-                            field_corr['version_value'] = diff[field_name]['old_value']
-
-                    if field_name in fields_corrections:
-                        fields_corrections[field_name].append(field_corr)
-                    else:
-                        fields_corrections[field_name] = [field_corr]
+                        fields_corrections.setdefault(changed_field_name, []).append(dict(
+                            base_corr,
+                            msg=correction.data['__all__'],
+                            version_value=changed_field_old_value['old_value']
+                        ))
+
+            for field_name in correction_fields:
+                own_fields_corrections.setdefault(field_name, []).append(dict(
+                    base_corr,
+                    msg=correction.data[field_name],
+                    version_value=diff[field_name]['old_value'] if field_name in diff else None
+                ))
+
+        for field_name, field_corrections in own_fields_corrections.items():
+            fields_corrections.setdefault(field_name, []).extend(field_corrections)
 
         return fields_corrections
 
     def get_context_data(self, **kwargs):
         context_data = super().get_context_data(**kwargs)
-        context_data['fields_corrections'] = self.get_fields_corrections(self.get_object())
+        context_data['fields_corrections'] = self.get_cached_fields_corrections()
         return context_data
 
     def get_form_kwargs(self):
         kwargs = super().get_form_kwargs()
         kwargs.update({
-            'fields_corrections': self.get_fields_corrections(self.get_object()),
+            'fields_corrections': self.get_cached_fields_corrections(),
             'linked_node': self.linked_node
         })
         return kwargs
@@ -509,7 +411,7 @@ class ApproveView(StopProposalMixin, DeliveryFormsetMixin, BaseView, ShowCorrect
         """ Создаёт объект Корректировки, если есть поля с заполненными корректировками """
         # Деактивируем корректировку для нашего текущего шага
         corrections_qs = form.instance.get_correction_active(
-            for_step=get_task_ref(self.linked_node)
+            for_step=task_ref(self.linked_node)
         )
         corrections_qs.update(is_active=False)
 
@@ -524,12 +426,16 @@ class ApproveView(StopProposalMixin, DeliveryFormsetMixin, BaseView, ShowCorrect
                 Correction.objects.create(
                     task=self.activation.task,
                     proposal=self.activation.process,
-                    for_step=get_task_ref(corr_settings['for_step']),
-                    reviewed_version=form.cleaned_data['current_version'],
+                    for_step=task_ref(corr_settings['for_step'], self.linked_node.flow_class),
+                    reviewed_version_id=form.cleaned_data['current_version'].version_id,
                     data=correction_data,
                     is_active=True,
                     owner=self.request.user
                 )
+        # Корректировки заявки изменились, посчитанные ранее fields_corrections больше не актуальны
+        self.invalidate_fields_corrections()
+        # Шлюзы после этого шага проверяют Корректировки по active_correction_steps того же объекта Заявки
+        self.activation.process.refresh_active_correction_steps()
 
         super().form_valid(form, *args, **kwargs)
         return HttpResponseRedirect(self.get_success_url())
@@ -599,18 +505,9 @@ class ClientAddDataView(AddDataView):
 
     def form_valid(self, form, *args, **kwargs):
         current_year = datetime.datetime.now().year
-        contract_number = 1
 
         p = self.get_object()
-        # last proposal, ordering = ['-created']
-        lp = ProposalProcess.objects.filter(contract_date__year=current_year).first()
-        if lp and lp.contract_number:
-            try:
-                contract_number = int(lp.contract_number.split('/')[0]) + 1
-            except ValueError:
-                pass
-
-        p.contract_number = '{}/{}'.format(contract_number, current_year)
+        p.contract_number = '{}/{}'.format(ContractCounter.allocate(current_year), current_year)
         p.contract_date = datetime.datetime.now()
         p.save()
 
@@ -646,8 +543,9 @@ class AddJCodeView(AddDataView):
 
     def form_valid(self, form, *args, **kwargs):
         if form.instance.is_needs_bibserve_account:
-            from michelin_bpm.main.flows import BibServeFlow
-            BibServeFlow.start.run(form.instance)
+            # Процесс BibServe запускается воркером ./manage.py process_task_events
+            # после коммита этой транзакции, см. michelin_bpm.main.signals.start_bibserve
+            TaskEvent.objects.create(task=self.activation.task, kind=TaskEvent.START_BIBSERVE)
         return super().form_valid(form, *args, **kwargs)
 
 
@@ -693,18 +591,71 @@ class ShowProposalView(DeliveryFormsetMixin, DetailProcessView):
 
 @method_decorator(login_required, name='dispatch')
 class MichelinProcessListView(ProcessListView):
+    """
+    Список процессов. По умолчанию отсортирован по убыванию pk (порядок создания).
+    Страница выбирается в два шага: сначала по узкому запросу только pk находится первая строка страницы,
+    затем загружаются length процессов начиная с неё, см. get_page.
+    Для клиентов и ACS запрос идёт по индексам (client, pk) и (acs, pk).
+    """
 
     list_display = [
         'process_id', 'process_summary', 'proposal_link',
         'created', 'finished', 'active_tasks'
     ]
 
+    def get_page(self, start, length):
+        """
+        Процессы страницы, начинающейся со start.
+        OFFSET пропускает только pk (без загрузки полных строк процессов), сами строки читаются с границы страницы.
+        Граница вычисляется на каждый запрос, поэтому страница всегда соответствует start, который передаёт datatables.
+        """
+        queryset = self.object_list
+        if not start or list(queryset.query.order_by) != ['-pk']:
+            return list(queryset[start:start + length])
+
+        first_pk = list(queryset.values_list('pk', flat=True)[start:start + 1])
+        if not first_pk:
+            return []
+        return list(queryset.filter(pk__lte=first_pk[0])[:length])
+
+    def get_table_data(self, start, length):
+        page = self.get_page(start, length)
+        # Кол-во активных задач всех процессов страницы одним запросом
+        self.active_tasks_count = dict(
+            Task.objects.filter(
+                process_id__in=[process.pk for process in page], finished__isnull=True
+            ).order_by().values('process_id').annotate(count=Count('pk')).values_list('process_id', 'count')
+        )
+        for item in page:
+            columns = OrderedDict()
+            for field_name in self.get_list_display():
+                attr = self.get_data_attr(field_name)
+                columns[field_name] = self.format_column(item, field_name, attr.get_value(item))
+            yield item, columns
+
+    def total(self):
+        if not hasattr(self, '_total'):
+            self._total = self.object_list.count()
+        return self._total
+
+    def total_filtered(self):
+        return self.total()
+
+    def active_tasks(self, process):
+        if process.finished is None:
+            return mark_safe('<a href="{}">{}</a>'.format(
+                self.get_process_link(process),
+                self.active_tasks_count.get(process.pk, 0))
+            )
+        return ''
+    active_tasks.short_description = _('Active Tasks')
+
     def get_show_proposal_link(self, process):
         if type(process) == ProposalProcess:
             proposal_pk = process.pk
 
         if type(process) == BibServeProcess:
-            proposal_pk = process.proposal.pk
+            proposal_pk = process.proposal_id
 
         url_name = '{}:show_proposal'.format(self.request.resolver_match.namespace)
         return reverse(url_name, args=[proposal_pk])
@@ -725,17 +676,20 @@ class MichelinProcessListView(ProcessListView):
 
     def get_queryset(self):
         queryset = super().get_queryset()
+        if not queryset.query.order_by:
+            queryset = queryset.order_by('-pk')
+        if queryset.model == BibServeProcess:
+            queryset = queryset.select_related('proposal')
 
-        is_client = self.request.user.groups.filter(pk=settings.CLIENTS_GROUP_ID).exists()
-        is_acs = self.request.user.groups.filter(pk=settings.ACS_GROUP_ID).exists()
-        if is_client:
+        roles = get_user_roles(self.request.user)
+        if roles.is_client:
             if queryset.model == ProposalProcess:
                 queryset = queryset.filter(client=self.request.user)
 
             if queryset.model == BibServeProcess:
                 queryset = queryset.filter(proposal__client=self.request.user)
 
-        if is_acs:
+        if roles.is_acs:
             queryset = queryset.filter(acs=self.request.user)
 
         return queryset
@@ -240,3 +240,38 @@ ACS_GROUP_ID = os.environ.get('ACS_GROUP_ID', 9)
 
 # Ссылка на BibServe, которая отправляется по емейлу после регистрации нового аккаунта на BibServe
 BIBSERVE_LINK = 'https://www.bibserve.com/'
+
+# Сколько раскодированных Версий Заявок держать в памяти процесса (см. ProposalProcess.get_version_data)
+VERSION_DATA_CACHE_SIZE = int(os.environ.get('VERSION_DATA_CACHE_SIZE', 1024))
+
+# Очередь писем для мейлера, см. ./manage.py send_queued_mail
+DB_MAILER_TIMEOUT = 10
+MAIL_QUEUE_BATCH_SIZE = 50
+MAIL_QUEUE_MAX_ATTEMPTS = 5
+# Задержка перед первой повторной попыткой, сек. Каждая следующая задержка вдвое больше.
+MAIL_QUEUE_RETRY_DELAY = 60
+# Через сколько секунд письмо, забранное упавшим воркером, снова попадает в очередь.
+# Должно быть больше, чем MAIL_QUEUE_BATCH_SIZE * DB_MAILER_TIMEOUT.
+MAIL_QUEUE_CLAIM_TIMEOUT = 600
+
+# Сколько раз воркер process_task_events пытается обработать событие по задаче
+TASK_EVENTS_MAX_ATTEMPTS = 5
+# Задержка перед первой повторной обработкой события, сек. Каждая следующая задержка вдвое больше.
+TASK_EVENTS_RETRY_DELAY = 30
+
+# Кэш сгенерированных Договоров и Карточек ОИЗ (см. main.documents.RenderCache)
+DOCUMENTS_CACHE_ROOT = os.environ.get('DOCUMENTS_CACHE_ROOT', os.path.join(MEDIA_ROOT, 'documents-cache'))
+# Максимальный суммарный размер кэша, байт
+DOCUMENTS_CACHE_MAX_SIZE = int(os.environ.get('DOCUMENTS_CACHE_MAX_SIZE', 512 * 1024 * 1024))
+
+# Пул процессов LibreOffice для конвертации Договоров в pdf (см. main.converter.ConverterPool).
+# Пул свой у каждого процесса веб-сервера.
+LIBREOFFICE_POOL_SIZE = int(os.environ.get('LIBREOFFICE_POOL_SIZE', 2))
+# Сколько секунд ждать конвертацию одного документа, после этого процесс LibreOffice перезапускается
+LIBREOFFICE_CONVERT_TIMEOUT = 60
+# Сколько секунд ждать свободный процесс LibreOffice
+LIBREOFFICE_QUEUE_TIMEOUT = 30
+
+# Кол-во процессов общего на веб-процесс пула для рендера Карточек ОИЗ при массовой выгрузке
+# (см. main.documents.get_export_executor). Все параллельные выгрузки делят этот пул.
+OIZ_CARDS_EXPORT_WORKERS = 2